@@ -0,0 +1,806 @@
+import asyncio
+import datetime
+import gc
+import json
+import platform
+import re
+import socket
+import subprocess
+import threading
+import time
+import tracemalloc
+
+import sml
+import shared_sml_data
+import http_api
+import sml_mqtt
+import snapshot_ring
+import obis
+import utils
+
+# encoders used to build SML traffic in the same layout as recorded from the
+# supported meters (see README.md). this keeps the benchmarks reproducible
+# without any serial hardware attached.
+
+
+def encode_tl(field_type, length):
+    # returns the TL byte(s) for a field, 'length' excludes the TL bytes
+    # themselves for octet strings and integers
+    if field_type != sml.TYPE_LIST:
+        tl_bytes = 1
+        while length + tl_bytes > (1 << (4 * tl_bytes)) - 1:
+            tl_bytes += 1
+        length += tl_bytes
+    else:
+        tl_bytes = 1
+        while length > (1 << (4 * tl_bytes)) - 1:
+            tl_bytes += 1
+    tl = bytearray()
+    for index in range(tl_bytes - 1, -1, -1):
+        nibble = (length >> (4 * index)) & sml.MASK_LENGTH
+        if index == tl_bytes - 1:
+            nibble |= field_type
+        if index > 0:
+            nibble |= sml.MASK_EXTENDED_TYPE
+        tl.append(nibble)
+    return bytes(tl)
+
+
+def octet_string(data):
+    if data is None:
+        return b"\x01"
+    return encode_tl(sml.TYPE_OCTET_STRING, len(data)) + data
+
+
+def unsigned(value, size):
+    return encode_tl(sml.TYPE_UNSIGNED_INT, size) + value.to_bytes(size, byteorder="big", signed=False)
+
+
+def signed(value, size):
+    return encode_tl(sml.TYPE_SIGNED_INT, size) + value.to_bytes(size, byteorder="big", signed=True)
+
+
+def sml_list(*elements):
+    return encode_tl(sml.TYPE_LIST, len(elements)) + b"".join(elements)
+
+
+def message(transaction_id, tag, body):
+    # the message CRC is not evaluated by sml-reader
+    return sml_list(
+        octet_string(transaction_id),
+        unsigned(0, 1),
+        unsigned(0, 1),
+        sml_list(unsigned(tag, 2), body),
+        unsigned(0, 2),
+        b"\x00",
+    )
+
+
+def escape(body):
+    # escape sequences on block boundaries are sent twice
+    escaped = bytearray()
+    for pos in range(0, len(body), 4):
+        block = body[pos:pos + 4]
+        escaped += block
+        if block == sml.ESCAPE_SEQ:
+            escaped += block
+    return bytes(escaped)
+
+
+def frame(*messages):
+    body = b"".join(messages)
+    fill_bytes = -len(body) % 4
+    body += b"\x00" * fill_bytes
+    data = sml.START_SEQ + escape(body) + sml.ESCAPE_SEQ + b"\x1a" + bytes([fill_bytes])
+    return data + sml.crc16(data).to_bytes(2, byteorder="little")
+
+
+def list_entry(obis_bytes, value, unit=None, scaler=None, status=None, val_time=None):
+    return sml_list(
+        octet_string(obis_bytes),
+        status if status is not None else b"\x01",
+        sml_list(unsigned(1, 1), unsigned(val_time, 4)) if val_time is not None else b"\x01",
+        unsigned(unit, 1) if unit is not None else b"\x01",
+        signed(scaler, 1) if scaler is not None else b"\x01",
+        value,
+        b"\x01",
+    )
+
+
+def get_list_frame(sequence, server_id, values, sensor_time=None):
+    # open response, a GetList.Response with the given list entries and a close response
+    transaction = sequence.to_bytes(4, byteorder="big")
+    open_response = sml_list(b"\x01", b"\x01", octet_string(transaction + b"\x00\x00"), octet_string(server_id), b"\x01", b"\x01")
+    list_response = sml_list(
+        b"\x01",
+        octet_string(server_id),
+        octet_string(b"\x01\x00\x62\x0a\xff\xff"),
+        sml_list(unsigned(1, 1), unsigned(sensor_time if sensor_time is not None else sequence, 4)),
+        sml_list(*values),
+        b"\x01",
+        b"\x01",
+    )
+    close_response = sml_list(b"\x01")
+    return frame(
+        message(transaction + b"\x01", 0x0101, open_response),
+        message(transaction + b"\x02", 0x0701, list_response),
+        message(transaction + b"\x03", 0x0201, close_response),
+    )
+
+
+def ed300l_frame(sequence=0, energy_in=58694500, power=14005, server_id=b"\x0a\x01\x45\x4d\x48\x00\x00\x12\x34\x56"):
+    # EMH ED300L: single tariff consumption meter with a public key
+    return get_list_frame(sequence, server_id, [
+        list_entry(b"\x81\x81\xC7\x82\x03\xFF", octet_string(b"EMH")),
+        list_entry(b"\x01\x00\x00\x00\x09\xFF", octet_string(server_id)),
+        list_entry(b"\x01\x00\x01\x08\x00\xFF", unsigned(energy_in, 8), unit=30, scaler=-1, status=unsigned(0x182, 2)),
+        list_entry(b"\x01\x00\x01\x08\x01\xFF", unsigned(energy_in, 8), unit=30, scaler=-1),
+        list_entry(b"\x01\x00\x01\x08\x02\xFF", unsigned(0, 8), unit=30, scaler=-1),
+        list_entry(b"\x01\x00\x0F\x07\x00\xFF", signed(power, 4), unit=27, scaler=-2),
+        list_entry(b"\x81\x81\xC7\x82\x05\xFF", octet_string(bytes(range(48)))),
+    ])
+
+
+def q3a_frame(sequence=0, energy_in=58694500, power=14005):
+    # EasyMeter Q3A: two way meter with per phase power readings and value timestamps
+    server_id = b"\x09\x01\x45\x53\x59\x11\x03\x9e\x4a\x26"
+    val_time = 86400 + sequence
+    return get_list_frame(sequence, server_id, [
+        list_entry(b"\x81\x81\xC7\x82\x03\xFF", octet_string(b"ESY")),
+        list_entry(b"\x01\x00\x00\x00\x09\xFF", octet_string(server_id)),
+        list_entry(b"\x01\x00\x01\x08\x00\xFF", unsigned(energy_in * 10, 8), unit=30, scaler=-2, status=unsigned(0x1820, 4), val_time=val_time),
+        list_entry(b"\x01\x00\x02\x08\x00\xFF", unsigned(energy_in // 7, 8), unit=30, scaler=-1, val_time=val_time),
+        list_entry(b"\x01\x00\x10\x07\x00\xFF", signed(power - 20000, 4), unit=27, scaler=-2),
+        list_entry(b"\x01\x00\x24\x07\x00\xFF", signed(power // 3, 4), unit=27, scaler=-2),
+        list_entry(b"\x01\x00\x38\x07\x00\xFF", signed(power // 3 - 20000, 4), unit=27, scaler=-2),
+        list_entry(b"\x01\x00\x4c\x07\x00\xFF", signed(power // 3, 4), unit=27, scaler=-2),
+    ], sensor_time=val_time)
+
+
+def mt631_frame(sequence=0, energy_in=58694500, power=14005):
+    # Iskra MT631: two tariff meter with serial number, small integers and a
+    # public key that requires escaping
+    server_id = b"\x0a\x01\x49\x53\x4b\x00\x04\x2d\x1f\x6b"
+    return get_list_frame(sequence, server_id, [
+        list_entry(b"\x81\x81\xC7\x82\x03\xFF", octet_string(b"ISK")),
+        list_entry(b"\x00\x00\x60\x01\xFF\xFF", octet_string(b"1ISK0074395499")),
+        list_entry(b"\x01\x00\x00\x00\x09\xFF", octet_string(server_id)),
+        list_entry(b"\x01\x00\x01\x08\x00\xFF", unsigned(energy_in, 5), unit=30, scaler=-1, status=unsigned(0x100104, 3)),
+        list_entry(b"\x01\x00\x01\x08\x01\xFF", unsigned(energy_in * 2 // 3, 5), unit=30, scaler=-1),
+        list_entry(b"\x01\x00\x01\x08\x02\xFF", unsigned(energy_in // 3, 5), unit=30, scaler=-1),
+        # integers are sent with as few bytes as possible, so the layout changes now and then
+        list_entry(b"\x01\x00\x02\x08\x00\xFF", unsigned(sequence, max(1, (sequence.bit_length() + 7) // 8)), unit=30, scaler=-1),
+        list_entry(b"\x01\x00\x10\x07\x00\xFF", signed(power // 100, 2), unit=27),
+        list_entry(b"\x81\x81\xC7\x82\x05\xFF", octet_string(b"\x1b" * 12 + bytes(range(36)))),
+    ])
+
+
+# frame builders of all meter models: (sequence, energy_in, power) -> frame
+METERS = {
+    "ed300l": ed300l_frame,
+    "q3a": q3a_frame,
+    "mt631": mt631_frame,
+}
+
+
+def capture(frame_count=100, meter="ed300l"):
+    # meters send one frame per second with some line noise in between
+    build = METERS[meter]
+    return b"".join(b"\x00\xff" + build(sequence, 58694500 + sequence, 14005 + sequence % 50) for sequence in range(frame_count))
+
+
+def corrupted_capture(frame_count=10, corrupted_count=1200):
+    # captures/ed300l-corrupt.bin: a long run of frames with a wrong checksum (more
+    # than fit into the recursion limit) and a frame with a valid checksum but an
+    # unknown field type, surrounded by intact frames
+    frames = [ed300l_frame(sequence) for sequence in range(frame_count // 2)]
+    for sequence in range(corrupted_count):
+        data = ed300l_frame(frame_count // 2 + sequence)
+        frames.append(data[:-1] + bytes([data[-1] ^ 0xff]))
+    server_id = b"\x0a\x01\x45\x4d\x48\x00\x00\x12\x34\x56"
+    frames.append(get_list_frame(frame_count // 2, server_id, [
+        list_entry(b"\x81\x81\xC7\x82\x03\xFF", octet_string(b"EMH")),
+        # type 2 does not exist
+        list_entry(b"\x01\x00\x0F\x07\x00\xFF", b"\x22\x00", unit=27, scaler=-2),
+    ]))
+    frames += [ed300l_frame(sequence) for sequence in range(frame_count // 2, frame_count)]
+    return b"".join(b"\x00\xff" + data for data in frames)
+
+
+def replay(data, chunk_size):
+    # split a capture into the chunks a serial read would return
+    return [data[pos:pos + chunk_size] for pos in range(0, len(data), chunk_size)]
+
+
+def benchmark_scanner(baudrates, frame_count=1000, rounds=5):
+    data = capture(frame_count)
+    results = []
+    for baudrate in baudrates:
+        # bytes arriving within one millisecond of line time (8N1 = 10 bits per byte)
+        chunk_size = max(1, baudrate // 10000)
+        chunks = replay(data, chunk_size)
+        best = None
+        for _ in range(rounds):
+            scanner = sml.FrameScanner()
+            frames = 0
+            start = time.perf_counter()
+            for chunk in chunks:
+                for _ in scanner.feed(chunk):
+                    frames += 1
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        line_time = len(data) * 10 / baudrate
+        results.append({
+            "baudrate": baudrate,
+            "chunk_size": chunk_size,
+            "frames": frames,
+            "bytes": len(data),
+            "seconds": best,
+            "mb_per_second": len(data) / best / 1e6,
+            "cpu_share": best / line_time,
+        })
+    return results
+
+
+def split_frames(data):
+    # (message, footer) copies of every frame in 'data'
+    scanner = sml.FrameScanner()
+    return [(bytes(msg), footer) for msg, footer in scanner.feed(data)]
+
+
+def benchmark_parser_memory(frame_count=100, meter="ed300l"):
+    frames = split_frames(capture(frame_count, meter))
+    gc.collect()
+    collections = sum(stats["collections"] for stats in gc.get_stats())
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        roots = [sml.parse_sml_bytestream(msg, footer) for msg, footer in frames]
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        # memory allocated while parsing a single frame, including temporary objects
+        transient = 0
+        for msg, footer in frames:
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            sml.parse_sml_bytestream(msg, footer)
+            transient += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    collections = sum(stats["collections"] for stats in gc.get_stats()) - collections
+    stats = after.compare_to(before, "filename")
+    retained = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    del roots
+    return {
+        "frames": len(frames),
+        "frame_bytes": sum(len(msg) for msg, _ in frames) / len(frames),
+        "retained_bytes_per_frame": retained / len(frames),
+        "retained_blocks_per_frame": blocks / len(frames),
+        "transient_bytes_per_frame": transient / len(frames),
+        "peak_bytes": peak,
+        "gc_collections": collections,
+    }
+
+
+def benchmark_parser(frame_count=1000, rounds=5, meter="ed300l"):
+    # parse every frame and read the OBIS data from it, like the publishers do.
+    # eager, lazy and layout mode get complete frames, stream mode the raw capture
+    frames = split_frames(capture(frame_count, meter))
+    results = []
+    for lazy in (False, True):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for msg, footer in frames:
+                root = sml.parse_sml_bytestream(msg, footer, lazy)
+                sml.extract_obis_response_data(root.GetListResponse())
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append({
+            "mode": "lazy" if lazy else "eager",
+            "frames": len(frames),
+            "seconds": best,
+            "frames_per_second": len(frames) / best,
+        })
+    # the stream parser consumes the raw capture in serial read sized chunks
+    chunks = replay(capture(frame_count, meter), 64)
+    best = None
+    for _ in range(rounds):
+        parser = sml.SML_Stream_Parser()
+        start = time.perf_counter()
+        for chunk in chunks:
+            for event, payload in parser.feed(chunk):
+                if event == sml.EVENT_FRAME_END:
+                    sml.extract_obis_response_data(payload[0].GetListResponse())
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    results.append({
+        "mode": "stream",
+        "frames": frame_count,
+        "seconds": best,
+        "frames_per_second": frame_count / best,
+    })
+    # the layout parser learns the layout from the first frame of every round
+    best = None
+    for _ in range(rounds):
+        parser = sml.SML_Layout_Parser()
+        start = time.perf_counter()
+        for msg, footer in frames:
+            parser.parse(msg, footer)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    results.append({
+        "mode": "layout",
+        "frames": len(frames),
+        "seconds": best,
+        "frames_per_second": len(frames) / best,
+    })
+    return results
+
+
+def benchmark_crc(frame_count=1000, rounds=5):
+    # checksum cost compared to parsing the very same frames
+    data = capture(frame_count)
+    frames = split_frames(data)
+    best_crc = None
+    best_parse = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for msg, footer in frames:
+            sml.crc16(msg)
+        elapsed = time.perf_counter() - start
+        if best_crc is None or elapsed < best_crc:
+            best_crc = elapsed
+        start = time.perf_counter()
+        for msg, footer in frames:
+            sml.parse_sml_bytestream(msg, footer)
+        elapsed = time.perf_counter() - start
+        if best_parse is None or elapsed < best_parse:
+            best_parse = elapsed
+    return {
+        "frames": len(frames),
+        "crc_us_per_frame": best_crc / len(frames) * 1e6,
+        "parse_us_per_frame": best_parse / len(frames) * 1e6,
+        "crc_share": best_crc / best_parse,
+    }
+
+
+def get_tl_positions(msg):
+    # positions of all type-length fields in an SML file
+    positions = []
+    pos = 0
+    while pos < len(msg):
+        if msg[pos] == 0x00:
+            pos += 1
+            continue
+        positions.append(pos)
+        is_list = msg[pos] & sml.MASK_TYPE == sml.TYPE_LIST
+        length, pos = sml.get_field_length(msg, pos)
+        pos += 1 if is_list else length
+    return positions
+
+
+def best_time(function, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_functions(frame_count=1000, rounds=5, meter="ed300l"):
+    # cost of the helpers every parsed frame goes through (in ns per call)
+    frames = split_frames(capture(frame_count, meter))
+    fields = [(msg, pos) for msg, _ in frames for pos in get_tl_positions(msg)]
+    responses = [sml.parse_sml_bytestream(msg, footer).GetListResponse() for msg, footer in frames]
+    octets = [entry.children[5].data for response in responses for entry in response.children[4].children
+              if isinstance(entry.children[5].data, bytes)]
+
+    def field_lengths():
+        for msg, pos in fields:
+            sml.get_field_length(msg, pos)
+
+    def extract():
+        for response in responses:
+            sml.extract_obis_response_data(response)
+
+    def hexlify():
+        for octet in octets:
+            utils.hexlify(octet)
+
+    results = []
+    for name, function, calls in (("get_field_length", field_lengths, len(fields)),
+                                  ("extract_obis_response_data", extract, len(responses)),
+                                  ("hexlify", hexlify, len(octets))):
+        results.append({
+            "function": name,
+            "calls": calls,
+            "ns_per_call": best_time(function, rounds) / calls * 1e9,
+        })
+    return results
+
+
+def count_elements(structure):
+    # number of elements (lists and values) below an SML structure
+    count = 0
+    for child in structure.children:
+        count += 1
+        if isinstance(child, sml.SML_Structure):
+            count += count_elements(child)
+    return count
+
+
+def benchmark_decoder(frame_count=1000, rounds=5, meter="ed300l"):
+    # elements decoded per second by the SML file parser, without OBIS extraction
+    frames = split_frames(capture(frame_count, meter))
+    elements = sum(count_elements(sml.parse_sml_bytestream(msg, footer)) for msg, footer in frames)
+    results = []
+    for lazy in (False, True):
+        parser = sml.SML_Parser(lazy)
+
+        def decode():
+            for msg, footer in frames:
+                parser.parse(msg, footer)
+
+        best = best_time(decode, rounds)
+        results.append({
+            "mode": "lazy" if lazy else "eager",
+            "elements": elements,
+            "elements_per_second": elements / best,
+        })
+    return results
+
+
+def publish_meters(meter_count):
+    # one snapshot per simulated meter, as if every meter had sent a frame
+    for meter in range(meter_count):
+        server_id = b"\x0a\x01\x45\x4d\x48\x00" + meter.to_bytes(4, byteorder="big")
+        for msg, footer in split_frames(ed300l_frame(meter, server_id=server_id)):
+            root = sml.parse_sml_bytestream(msg, footer)
+            shared_sml_data.publish(root, sml.get_server_id(root))
+
+
+async def scrape(port, path, request_count, headers="", latencies=None):
+    # sends 'request_count' requests over a keep-alive connection (reconnecting if
+    # the server closes it) and records the latency of every request in 'latencies'
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = "GET {} HTTP/1.1\r\nHost: localhost\r\n{}\r\n".format(path, headers).encode("latin-1")
+    for _ in range(request_count):
+        start = time.perf_counter()
+        writer.write(request)
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        await reader.readexactly(int(re.search(rb"(?i)Content-Length: (\d+)", head).group(1)))
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start)
+        if head.startswith(b"HTTP/1.0") or re.search(rb"(?i)Connection: close", head):
+            writer.close()
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.close()
+
+
+async def load_test(path, request_count, concurrency, headers=""):
+    server = await asyncio.start_server(http_api.handle_async_request, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    await asyncio.gather(*(scrape(port, path, request_count // concurrency, headers) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+
+def benchmark_metrics(meter_count=4, request_count=2000, concurrency=10):
+    # cost of a /metrics scrape: rendering the exposition for every request (as
+    # sml-reader used to) compared to the cached response, and requests per second
+    # of the asyncio API for plain, gzip and conditional scrapes
+    publish_meters(meter_count)
+    snapshots = shared_sml_data.get_snapshots()
+    results = []
+    for mode, render in (("render", lambda: http_api.render_prometheus_metrics(snapshots)), ("cached", http_api.get_prometheus_metrics)):
+        start = time.perf_counter()
+        for _ in range(request_count):
+            render()
+        elapsed = time.perf_counter() - start
+        results.append({
+            "mode": mode,
+            "requests": request_count,
+            "seconds": elapsed,
+            "requests_per_second": request_count / elapsed,
+        })
+    http_api.get_async_responses()
+    etag = http_api.get_prometheus_metrics().etag
+    for mode, headers in (("http", ""), ("http gzip", "Accept-Encoding: gzip\r\n"), ("http 304", "If-None-Match: {}\r\n".format(etag))):
+        elapsed = asyncio.run(load_test("/metrics", request_count, concurrency, headers))
+        results.append({
+            "mode": mode,
+            "requests": request_count // concurrency * concurrency,
+            "seconds": elapsed,
+            "requests_per_second": request_count // concurrency * concurrency / elapsed,
+        })
+    return results
+
+
+def benchmark_obis_dump(meter_count=4, request_count=2000, concurrency=10):
+    # cost of an /obis-dump request: encoding all datapoints for every request (as
+    # sml-reader used to) compared to the per snapshot cache, a subset and a single
+    # datapoint, and requests per second of the asyncio API for the cached paths
+    publish_meters(meter_count)
+    snapshot = shared_sml_data.get_snapshot()
+    # with several meters only the routes with a meter id answer with data
+    dump_path = "/obis-dump/{}".format(snapshot.meter_id)
+    single_path = "/obis/{}/energy_current".format(snapshot.meter_id)
+    results = []
+    for mode, render in (
+            ("render", lambda: json.dumps(sml.get_obis_data(snapshot)).encode()),
+            ("cached", lambda: http_api.get_obis_response(dump_path, {})),
+            ("subset", lambda: http_api.get_obis_response(dump_path, {"codes": "energy_current,energy_in_no_tariff"})),
+            ("single", lambda: http_api.get_obis_response(single_path, {}))):
+        start = time.perf_counter()
+        for _ in range(request_count):
+            render()
+        elapsed = time.perf_counter() - start
+        results.append({
+            "mode": mode,
+            "requests": request_count,
+            "seconds": elapsed,
+            "requests_per_second": request_count / elapsed,
+        })
+    http_api.get_async_responses()
+    etag = http_api.get_version_etag(snapshot)
+    for mode, path, headers in (
+            ("http", dump_path, ""),
+            ("http single", single_path, ""),
+            ("http 304", single_path, "If-None-Match: {}\r\n".format(etag))):
+        elapsed = asyncio.run(load_test(path, request_count, concurrency, headers))
+        results.append({
+            "mode": mode,
+            "requests": request_count // concurrency * concurrency,
+            "seconds": elapsed,
+            "requests_per_second": request_count // concurrency * concurrency / elapsed,
+        })
+    return results
+
+
+def benchmark_ring(record_count=1000, rounds=5, meter="ed300l"):
+    # snapshots written to and read from the shared memory ring per second. the
+    # ring holds all records, so every round reads what it has written
+    frames = split_frames(capture(record_count, meter))
+    records = []
+    for number, (msg, footer) in enumerate(frames):
+        root = sml.parse_sml_bytestream(msg, footer)
+        records.append({
+            "version": number + 1,
+            "timestamp": time.time(),
+            "meter_id": sml.get_server_id(root),
+            "obis_data": sml.extract_obis_response_data(root.GetListResponse()),
+        })
+    writer = snapshot_ring.RingWriter(slot_count=len(records))
+    reader = snapshot_ring.RingReader(writer.name)
+    try:
+        write_best = read_best = None
+        for _ in range(rounds):
+            first = writer.count + 1
+            start = time.perf_counter()
+            for record in records:
+                writer.append(record)
+            elapsed = time.perf_counter() - start
+            write_best = elapsed if write_best is None else min(write_best, elapsed)
+            start = time.perf_counter()
+            for _ in reader.read_records(first):
+                pass
+            elapsed = time.perf_counter() - start
+            read_best = elapsed if read_best is None else min(read_best, elapsed)
+    finally:
+        reader.close()
+        writer.close()
+    return {
+        "records": len(records),
+        "writes_per_second": len(records) / write_best,
+        "reads_per_second": len(records) / read_best,
+    }
+
+
+def benchmark_events(client_count=1000, frame_count=100, meter="ed300l"):
+    # time to push a new snapshot to 'client_count' /events clients (half of them
+    # only want changes), without the sockets. queues are emptied after every frame
+    async def run():
+        stream = http_api.EventStream()
+        clients = [stream.subscribe(changes=index % 2 == 1) for index in range(client_count)]
+        snapshots = []
+        for msg, footer in split_frames(capture(frame_count, meter)):
+            root = sml.parse_sml_bytestream(msg, footer)
+            snapshots.append({"meter": shared_sml_data.Snapshot(len(snapshots) + 1, root, "meter")})
+        elapsed = 0
+        for snapshots_by_meter in snapshots:
+            start = time.perf_counter()
+            stream.publish(snapshots_by_meter)
+            elapsed += time.perf_counter() - start
+            for client in clients:
+                while not client.queue.empty():
+                    client.queue.get_nowait()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    return {
+        "clients": client_count,
+        "frames": frame_count,
+        "us_per_frame": elapsed / frame_count * 1e6,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_api_server(server, max_connections):
+    # runs the HTTP API in a background thread like sml-reader.py does
+    port = free_port()
+    thread = threading.Thread(name="HttpApi-{}".format(server), target=http_api.start_api, args=("127.0.0.1", port, server, max_connections), daemon=True)
+    thread.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return port
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError("HTTP API ({}) did not come up".format(server))
+
+
+def percentile(values, share):
+    # 'values' must be sorted
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def benchmark_api_latency(servers, meter_count=4, client_count=128, request_count=50, path="/metrics"):
+    # 'client_count' concurrent clients scrape 'path' 'request_count' times each
+    publish_meters(meter_count)
+    results = []
+    for server in servers:
+        port = start_api_server(server, client_count)
+        latencies = []
+        start = time.perf_counter()
+
+        async def run_clients():
+            await asyncio.gather(*(scrape(port, path, request_count, "", latencies) for _ in range(client_count)))
+        asyncio.run(run_clients())
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        results.append({
+            "server": server,
+            "clients": client_count,
+            "requests": len(latencies),
+            "requests_per_second": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        })
+    return results
+
+
+def read_http_response(sock, buffer):
+    # reads one HTTP response from a keep-alive connection, returns the body and
+    # whatever was received after it
+    while b"\r\n\r\n" not in buffer:
+        buffer += sock.recv(65536)
+    head, buffer = buffer.split(b"\r\n\r\n", 1)
+    length = int(re.search(rb"(?i)Content-Length: (\d+)", head).group(1))
+    while len(buffer) < length:
+        buffer += sock.recv(65536)
+    return buffer[:length], buffer[length:]
+
+
+def benchmark_end_to_end(frame_count=200, meter="ed300l"):
+    # latency from the last byte of a frame arriving on the serial line to the /metrics
+    # response containing it: frame detection, parsing, publishing and the HTTP API
+    port = start_api_server("async", 10)
+    frames = [b"\x00\xff" + METERS[meter](sequence, 58694500 + sequence, 14005 + sequence % 50) for sequence in range(frame_count)]
+    scanner = sml.FrameScanner()
+    request = b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    latencies = []
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b""
+        for data in frames:
+            for _ in scanner.feed(data[:-1]):
+                raise RuntimeError("frame detected before its last byte")
+            start = time.perf_counter()
+            for msg, footer in scanner.feed(data[-1:]):
+                root = sml.parse_sml_bytestream(msg, footer)
+                shared_sml_data.publish(root, sml.get_server_id(root))
+            sock.sendall(request)
+            _, buffer = read_http_response(sock, buffer)
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "meter": meter,
+        "frames": len(latencies),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def benchmark_mqtt(host, port=1883, frame_count=1000, meter="ed300l", timeout=60):
+    # how fast snapshots are turned into queued MQTT messages and how fast the broker
+    # at 'host' accepts them (per value topics and json payloads)
+    snapshots = []
+    for version, (msg, footer) in enumerate(split_frames(capture(frame_count, meter)), 1):
+        root = sml.parse_sml_bytestream(msg, footer)
+        snapshots.append(shared_sml_data.Snapshot(version, root, sml.get_server_id(root)))
+    results = []
+    for json_payload in (False, True):
+        client = sml_mqtt.connect(host, port, queue_size=len(snapshots) * len(obis.CODES), json_payload=json_payload)
+        with client.condition:
+            if not client.condition.wait_for(lambda: client.connected, timeout):
+                raise RuntimeError("Could not connect to MQTT broker at {}:{}".format(host, port))
+        start = time.perf_counter()
+        for snapshot in snapshots:
+            sml_mqtt.publish_snapshot(client, snapshot.meter_id, snapshot)
+        queued = time.perf_counter() - start
+        deadline = time.monotonic() + timeout
+        while client.sent < client.queued and time.monotonic() < deadline:
+            time.sleep(0.01)
+        sent = time.perf_counter() - start
+        counters = client.get_counters()
+        client.client.loop_stop()
+        client.client.disconnect()
+        results.append({
+            "mode": "json" if json_payload else "values",
+            "snapshots": len(snapshots),
+            "messages": counters["sent"],
+            "snapshots_per_second": len(snapshots) / queued,
+            "messages_per_second": counters["sent"] / sent,
+        })
+    return results
+
+
+def get_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def save_results(path, metrics):
+    # metrics: name -> {"value", "unit", "better"} ("better" is "higher" or "lower")
+    with open(path, "w") as fout:
+        json.dump({"meta": get_metadata(), "metrics": metrics}, fout, indent=2, sort_keys=True)
+        fout.write("\n")
+
+
+def load_results(path):
+    with open(path) as fin:
+        return json.load(fin)
+
+
+def compare_results(baseline, metrics, tolerance=0.1):
+    # returns (name, baseline value, value, relative change, regression) of every
+    # metric found in both results. a change for the worse by more than 'tolerance'
+    # is a regression
+    changes = []
+    for name, metric in sorted(metrics.items()):
+        if name not in baseline["metrics"]:
+            continue
+        before = baseline["metrics"][name]["value"]
+        value = metric["value"]
+        change = (value - before) / before if before else 0.0
+        worse = -change if metric["better"] == "higher" else change
+        changes.append((name, before, value, change, worse > tolerance))
+    return changes
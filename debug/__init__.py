@@ -1,4 +1,3 @@
-import threading
 import time
 import logging
 
@@ -7,17 +6,37 @@ import shared_sml_data
 import obis
 
 
+def write_sml_dump(file_path, snapshots):
+    with open(file_path, "w") as fout:
+        logging.info("Dumping current SML data to {}".format(file_path))
+        for meter_id, snapshot in snapshots.items():
+            if len(snapshots) > 1:
+                fout.write("Meter {}\n".format(meter_id))
+            data = "\n".join(snapshot.root.RecursiveDump()) + "\n"
+            fout.write(data)
+
+
+def print_snapshot_obis_data(meter_id, snapshot):
+    obis_data = sml.get_obis_data(snapshot)
+    if obis_data is not None:
+        print("Dumping OBIS data of meter {} to console".format(meter_id))
+        for _, data in obis_data.items():
+            if data["unit"] is None:
+                print(" {}: {}".format(data["description"], data["value"]))
+            else:
+                print(" {}: {}{}".format(data["description"], data["value"], data["unit"]))
+        print()
+    else:
+        logging.warning("Could not print any OBIS data of meter {} - none found in the last SML message".format(meter_id))
+
+
 def dump_sml_data(interval, file_path):
     # add some initial wait here
     time.sleep(2)
     while True:
-        if shared_sml_data.SML_RAW_DATA is not None:
-            lock = threading.Lock()
-            with lock:
-                with open(file_path, "w") as fout:
-                    logging.info("Dumping current SML data to {}".format(file_path))
-                    data = "\n".join(shared_sml_data.SML_RAW_DATA.GetRoot().RecursiveDump()) + "\n"
-                    fout.write(data)
+        snapshots = shared_sml_data.get_snapshots()
+        if snapshots:
+            write_sml_dump(file_path, snapshots)
         time.sleep(interval)
 
 
@@ -25,21 +44,9 @@ def print_obis_data(interval):
     # add some initial wait here
     time.sleep(2)
     while True:
-        lock = threading.Lock()
-        with lock:
-            if shared_sml_data.SML_RAW_DATA is not None:
-                list_response = shared_sml_data.SML_RAW_DATA.GetRoot().GetListResponse()
-                if list_response is not None:
-                    obis_data = sml.extract_obis_response_data(list_response)
-                    print("Dumping OBIS data to console")
-                    for _, data in obis_data.items():
-                        if data["unit"] is None:
-                            print(" {}: {}".format(data["description"], data["value"]))
-                        else:
-                            print(" {}: {}{}".format(data["description"], data["value"], data["unit"]))
-                    print()
-                else:
-                    logging.warning("Could not print any OBIS data - none found in the last SML message")
-            else:
-                logging.warning("Could not print any OBIS data - no SML data received (yet)")
+        snapshots = shared_sml_data.get_snapshots()
+        if not snapshots:
+            logging.warning("Could not print any OBIS data - no SML data received (yet)")
+        for meter_id, snapshot in snapshots.items():
+            print_snapshot_obis_data(meter_id, snapshot)
         time.sleep(interval)
@@ -0,0 +1,424 @@
+import array
+import bisect
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+import sml
+import shared_sml_data
+import obis
+
+# append-only history of OBIS values. every meter gets its own directory of
+# segment files, a new segment is started every 'segment_duration' seconds.
+# a segment file starts with a header:
+#   magic (4 bytes) | format version (uint16) | length of the JSON part (uint16) | JSON
+# the JSON part holds the start of the segment (unix time) and the names of the
+# stored codes. fixed-width records follow:
+#   milliseconds since segment start (uint32) | one value per code
+# counters are stored as doubles, gauges as floats. missing values are NaN.
+# rollup segments of every meter (in 'rollup-<seconds>' subdirectories) use the
+# same format, storing the number of readings and min/max/sum/last per code
+
+MAGIC = b"SMLH"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHH")
+SEGMENT_SUFFIX = ".seg"
+# the millisecond offsets of a segment overflow after 2**32 ms (49.7 days), no
+# segment may cover more than this (whole days keep segment starts aligned)
+MAX_SEGMENT_DURATION = 49 * 86400
+
+
+# rollups are kept for 1 minute, 15 minutes and 1 hour buckets
+ROLLUP_RESOLUTIONS = (60, 900, 3600)
+ROLLUP_AGGREGATIONS = ("min", "max", "sum", "last")
+AGGREGATIONS = ("min", "max", "avg", "last")
+
+
+def get_stored_codes():
+    # codes with numeric values, in the order they are stored in
+    return [code for code, item in obis.CODES.items() if item["type"] in [obis.TYPE_GAUGE, obis.TYPE_COUNTER]]
+
+
+def get_record_format(codes):
+    return "<I" + "".join("d" if obis.CODES[code]["type"] == obis.TYPE_COUNTER else "f" for code in codes)
+
+
+def get_meter_directory_name(meter_id):
+    # meters without server id are identified by their device path
+    return str(meter_id).strip("/").replace("/", "_")
+
+
+class Segment():
+    # a single segment file, memory mapped for reading. only records that were
+    # completely written when the segment was opened are visible
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fin:
+            magic, version, json_length = HEADER.unpack(fin.read(HEADER.size))
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError("{} is not a history segment (version {})".format(path, FORMAT_VERSION))
+            header = json.loads(fin.read(json_length))
+            self.start = header["start"]
+            self.names = header["codes"]
+            self.record = struct.Struct(header["format"])
+            self.offset = HEADER.size + json_length
+            size = os.fstat(fin.fileno()).st_size
+            self.count = (size - self.offset) // self.record.size
+            self.map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) if self.count else None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+    def timestamp(self, index):
+        offset = self.offset + index * self.record.size
+        return self.start + struct.unpack_from("<I", self.map, offset)[0] / 1000
+
+    def find(self, timestamp):
+        # index of the first record at or after 'timestamp'
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, first, last):
+        # unpacked records in [first, last)
+        view = memoryview(self.map)[self.offset + first * self.record.size:self.offset + last * self.record.size]
+        try:
+            return list(self.record.iter_unpack(view))
+        finally:
+            view.release()
+
+
+class SegmentWriter():
+    # appends records to a segment. records are buffered and written by flush(),
+    # so an SD card only sees a write every few seconds
+    def __init__(self, directory, start, names, record_format):
+        self.slot = start
+        self.record = struct.Struct(record_format)
+        self.start = start
+        self.path = os.path.join(directory, "{:010d}{}".format(start, SEGMENT_SUFFIX))
+        self.pending = bytearray()
+        self.pending_offset = 0
+        header = json.dumps({"start": start, "codes": names, "format": self.record.format}).encode()
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, len(header)) + header
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as fin:
+                existing = fin.read(len(header))
+            if existing != header:
+                raise ValueError("{} was written with a different record layout".format(self.path))
+            # drop a partially written record left behind by a crash
+            size = os.path.getsize(self.path)
+            complete = len(header) + (size - len(header)) // self.record.size * self.record.size
+            if complete != size:
+                logging.warning("Dropping {} bytes of an incomplete record in {}".format(size - complete, self.path))
+                os.truncate(self.path, complete)
+        else:
+            self.pending += header
+            self.pending_offset = len(header)
+
+    def append(self, timestamp, values):
+        self.pending += self.record.pack(int((timestamp - self.start) * 1000), *values)
+
+    def flush(self):
+        if self.pending:
+            with open(self.path, "ab") as fout:
+                fout.write(self.pending)
+            self.pending = bytearray()
+            self.pending_offset = 0
+
+
+class Rollup():
+    # aggregates the readings of one meter into buckets of 'resolution' seconds.
+    # a bucket is emitted once a reading of a later bucket shows up
+    def __init__(self, resolution, codes):
+        self.resolution = resolution
+        self.codes = codes
+        self.bucket = None
+        self.count = 0
+
+    def reset(self, bucket):
+        self.bucket = bucket
+        self.count = 0
+        self.minimums = [math.inf] * len(self.codes)
+        self.maximums = [-math.inf] * len(self.codes)
+        self.sums = [0.0] * len(self.codes)
+        self.lasts = [math.nan] * len(self.codes)
+
+    def add(self, timestamp, values):
+        # returns the values of the previous bucket once it is complete, else None
+        bucket = timestamp // self.resolution * self.resolution
+        completed = None
+        if bucket != self.bucket:
+            completed = self.get_values()
+            self.reset(bucket)
+        self.count += 1
+        for index, value in enumerate(values):
+            # NaN never compares, it only shows up in the sum (and thus the average)
+            if value < self.minimums[index]:
+                self.minimums[index] = value
+            if value > self.maximums[index]:
+                self.maximums[index] = value
+            self.sums[index] += value
+            self.lasts[index] = value
+        return completed
+
+    def get_values(self):
+        # (bucket, record values) of the current bucket or None if it is empty
+        if not self.count:
+            return None
+        values = [self.count]
+        for index in range(len(self.codes)):
+            minimum = self.minimums[index] if self.minimums[index] != math.inf else math.nan
+            maximum = self.maximums[index] if self.maximums[index] != -math.inf else math.nan
+            values += [minimum, maximum, self.sums[index], self.lasts[index]]
+        return self.bucket, values
+
+
+def extend_columns(timestamps, columns, start, names, rows):
+    # appends records (tuples of millisecond offset and values) to query results
+    rows = list(zip(*rows))
+    timestamps.extend(start + offset / 1000 for offset in rows[0])
+    for name, values in zip(names, rows[1:]):
+        column = columns.get(name)
+        if column is None:
+            # a code that older segments did not store
+            column = columns[name] = array.array("d", [math.nan] * (len(timestamps) - len(values)))
+        column.extend(values)
+    for name, column in columns.items():
+        if len(column) < len(timestamps):
+            column.extend([math.nan] * (len(timestamps) - len(column)))
+
+
+def get_rollup_layout(codes):
+    # rollup segments store the number of readings and min/max/sum/last per code
+    names = ["count"]
+    record_format = "<II"
+    for code in codes:
+        value_format = "d" if obis.CODES[code]["type"] == obis.TYPE_COUNTER else "f"
+        for aggregation in ROLLUP_AGGREGATIONS:
+            names.append("{}:{}".format(obis.CODES[code]["internal_name"], aggregation))
+        record_format += value_format + value_format + "d" + value_format
+    return names, record_format
+
+
+class HistoryStore():
+    def __init__(self, path, segment_duration=86400, flush_interval=60):
+        if not 0 < segment_duration <= MAX_SEGMENT_DURATION:
+            raise ValueError("segment duration must be between 1 and {} seconds".format(MAX_SEGMENT_DURATION))
+        self.path = path
+        self.segment_duration = segment_duration
+        self.flush_interval = flush_interval
+        self.codes = get_stored_codes()
+        self.names = [obis.CODES[code]["internal_name"] for code in self.codes]
+        self.record_format = get_record_format(self.codes)
+        self.rollup_names, self.rollup_format = get_rollup_layout(self.codes)
+        self.writers = {}
+        self.rollups = {}
+        self.versions = {}
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def get_directory(self, meter_id, resolution=None):
+        directory = os.path.join(self.path, get_meter_directory_name(meter_id))
+        if resolution is not None:
+            directory = os.path.join(directory, "rollup-{}".format(resolution))
+        return directory
+
+    def get_writer(self, meter_id, timestamp, resolution=None):
+        # rollup segments cover about as many buckets as a raw segment covers seconds
+        if resolution is None:
+            duration = self.segment_duration
+            names, record_format = self.names, self.record_format
+        else:
+            duration = min(max(self.segment_duration, resolution * 1440), MAX_SEGMENT_DURATION)
+            names, record_format = self.rollup_names, self.rollup_format
+        start = int(timestamp // duration * duration)
+        writer = self.writers.get((meter_id, resolution))
+        if writer is not None and writer.slot == start:
+            return writer
+        if writer is not None:
+            writer.flush()
+        directory = self.get_directory(meter_id, resolution)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            writer = SegmentWriter(directory, start, names, record_format)
+        except ValueError as e:
+            # the stored codes changed, start a new segment right now
+            logging.warning("{}, starting a new segment".format(e))
+            writer = SegmentWriter(directory, int(timestamp), names, record_format)
+        writer.slot = start
+        logging.info("Writing history of meter {} to {}".format(meter_id, writer.path))
+        self.writers[(meter_id, resolution)] = writer
+        return writer
+
+    def append_rollup(self, meter_id, resolution, completed):
+        if completed is not None:
+            bucket, values = completed
+            self.get_writer(meter_id, bucket, resolution).append(bucket, values)
+
+    def append(self, meter_id, timestamp, obis_data):
+        values = []
+        for code in self.codes:
+            value = obis_data[code]["value"]
+            values.append(math.nan if value is None else value)
+        with self.lock:
+            self.get_writer(meter_id, timestamp).append(timestamp, values)
+            for resolution in ROLLUP_RESOLUTIONS:
+                rollup = self.rollups.get((meter_id, resolution))
+                if rollup is None:
+                    rollup = self.rollups[(meter_id, resolution)] = Rollup(resolution, self.codes)
+                self.append_rollup(meter_id, resolution, rollup.add(timestamp, values))
+
+    def record(self, snapshots):
+        # appends every snapshot that has not been recorded yet and flushes
+        # the buffered records once 'flush_interval' has passed
+        for meter_id, snapshot in snapshots.items():
+            if self.versions.get(meter_id) == snapshot.version:
+                continue
+            self.versions[meter_id] = snapshot.version
+            obis_data = sml.get_obis_data(snapshot)
+            if obis_data is not None:
+                self.append(meter_id, snapshot.timestamp, obis_data)
+        if time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            for writer in self.writers.values():
+                writer.flush()
+            self.flushed = time.monotonic()
+
+    def close(self):
+        # writes incomplete rollup buckets as well. should the same bucket be
+        # continued after a restart, queries merge both records
+        with self.lock:
+            for (meter_id, resolution), rollup in self.rollups.items():
+                self.append_rollup(meter_id, resolution, rollup.get_values())
+            self.rollups = {}
+        self.flush()
+
+    def get_meters(self):
+        return sorted(entry for entry in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, entry)))
+
+    def get_segments(self, meter_id, resolution=None):
+        # segment paths of a meter (or of one of its rollups), oldest first
+        directory = self.get_directory(meter_id, resolution)
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(SEGMENT_SUFFIX)]
+
+    def query(self, meter_id, start, end, resolution=None):
+        # all records of a meter (or of one of its rollups) in [start, end) as
+        # columns: an array of timestamps and an array of values per column name.
+        # this includes buffered records and the rollup bucket still in progress
+        timestamps = array.array("d")
+        columns = {}
+        segments = self.get_segments(meter_id, resolution)
+        for position, path in enumerate(segments):
+            # segments are sorted by their start, skip those that cannot match
+            if position + 1 < len(segments) and int(os.path.basename(segments[position + 1])[:-len(SEGMENT_SUFFIX)]) <= start:
+                continue
+            segment = Segment(path)
+            try:
+                if segment.start >= end:
+                    break
+                if not segment.count:
+                    continue
+                first = segment.find(start)
+                last = segment.find(end)
+                if first != last:
+                    extend_columns(timestamps, columns, segment.start, segment.names, segment.records(first, last))
+            finally:
+                segment.close()
+        with self.lock:
+            writer = self.writers.get((meter_id, resolution))
+            if writer is not None and writer.pending:
+                rows = [row for row in writer.record.iter_unpack(writer.pending[writer.pending_offset:]) if start <= writer.start + row[0] / 1000 < end]
+                if rows:
+                    extend_columns(timestamps, columns, writer.start, self.rollup_names if resolution else self.names, rows)
+            rollup = self.rollups.get((meter_id, resolution))
+            current = rollup.get_values() if rollup is not None else None
+            if current is not None and start <= current[0] < end:
+                extend_columns(timestamps, columns, current[0], self.rollup_names, [[0] + current[1]])
+        return timestamps, columns
+
+    def get_resolution(self, step):
+        # the coarsest rollup that step buckets can be built from, None for raw data
+        for resolution in sorted(ROLLUP_RESOLUTIONS, reverse=True):
+            if resolution <= step and step % resolution == 0:
+                return resolution
+        return None
+
+    def aggregate(self, meter_id, names, start, end, step, aggregations):
+        # aggregates the given columns into buckets of 'step' seconds, aligned to
+        # multiples of 'step'. returns the rollup resolution used (None for raw data)
+        # and {name: {aggregation: [(bucket, value), ...]}}, empty buckets are left out.
+        # every bucket is reduced with builtins over array slices instead of
+        # looping over single readings
+        start = start // step * step
+        resolution = self.get_resolution(step)
+        timestamps, columns = self.query(meter_id, start, end, resolution)
+        counts = columns.get("count")
+        # slice boundaries of all buckets
+        boundaries = []
+        bucket = start
+        position = 0
+        while bucket < end and position < len(timestamps):
+            following = bisect.bisect_left(timestamps, bucket + step, position)
+            if following > position:
+                boundaries.append((bucket, position, following))
+            position = following
+            bucket = timestamps[position] // step * step if position < len(timestamps) else end
+        result = {}
+        for name in names:
+            series = result[name] = {}
+            if resolution is None:
+                values = columns.get(name)
+                minimums = maximums = lasts = values
+            else:
+                values = columns.get(name + ":sum")
+                minimums = columns.get(name + ":min")
+                maximums = columns.get(name + ":max")
+                lasts = columns.get(name + ":last")
+            for aggregation in aggregations:
+                points = series[aggregation] = []
+                if values is None:
+                    continue
+                for bucket, first, last in boundaries:
+                    # missing values (NaN) never compare, min/max would depend on their position
+                    if aggregation == "min":
+                        value = min((value for value in minimums[first:last] if value == value), default=math.nan)
+                    elif aggregation == "max":
+                        value = max((value for value in maximums[first:last] if value == value), default=math.nan)
+                    elif aggregation == "last":
+                        value = lasts[last - 1]
+                    elif resolution is None:
+                        value = math.fsum(values[first:last]) / (last - first)
+                    else:
+                        value = math.fsum(values[first:last]) / sum(counts[first:last])
+                    points.append((bucket, value))
+        return resolution, result
+
+
+def start_history(store):
+    version = 0
+    while True:
+        snapshot = shared_sml_data.wait_for_snapshot(version, store.flush_interval)
+        if snapshot is not None:
+            version = snapshot.version
+        try:
+            store.record(shared_sml_data.get_snapshots())
+        except Exception:
+            # keep recording later snapshots, e.g. after the disk was full
+            logging.exception("Could not record history")
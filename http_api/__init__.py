@@ -1,56 +1,624 @@
+import asyncio
+import functools
+import gzip
+import hashlib
 import json
-import threading
-from flask import Flask, Response
+import logging
+import math
+import time
+import urllib.parse
+from flask import Flask, Response, request
 
 import sml
 import shared_sml_data
 import obis
+import history
+import instrumentation
 
 app = Flask(__name__)
 
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4;charset=UTF-8"
+# labels of the obis_* samples. meters that do not send their identity all get the
+# same "unknown ..." values, 'meter' (the meter id) keeps their samples apart
+OBIS_LABELS = ("manufacturer", "serial", "serverid", "meter")
+# smaller bodies (e.g. single datapoints) are not worth compressing
+GZIP_MIN_SIZE = 512
+
+
+class CachedResponse():
+    # a response rendered once and shared by all requests. the ETag is derived from
+    # the body unless given, the gzip variant is only compressed once somebody asks for it
+    __slots__ = ("version", "created", "status", "content_type", "body", "etag", "_gzip_body")
+
+    def __init__(self, version, status, content_type, body, etag=None):
+        self.version = version
+        self.created = time.monotonic()
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+        self.etag = etag or '"{}"'.format(hashlib.md5(body).hexdigest())
+        self._gzip_body = None
+
+    @property
+    def gzip_body(self):
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(self.body, 6)
+        return self._gzip_body
+
+    @property
+    def gzip_etag(self):
+        # the compressed variant is a different representation and needs its own ETag
+        return self.etag[:-1] + '-gzip"'
+
+    def select(self, if_none_match, accept_encoding):
+        # returns (status, body, headers) for the given request headers
+        use_gzip = "gzip" in accept_encoding and len(self.body) >= GZIP_MIN_SIZE
+        etag = self.gzip_etag if use_gzip else self.etag
+        headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+        if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+            return 304, b"", headers
+        if use_gzip:
+            headers["Content-Encoding"] = "gzip"
+            return self.status, self.gzip_body, headers
+        return self.status, self.body, headers
+
+
+def encode_obis_items(snapshot):
+    # JSON of every OBIS datapoint of a snapshot (code -> bytes), None if there are none
+    obis_data = sml.get_obis_data(snapshot)
+    if obis_data is None:
+        return None
+    return {code: json.dumps(item).encode() for code, item in obis_data.items()}
+
+
+def join_obis_items(items, codes):
+    # JSON document of the given datapoints, byte for byte what json.dumps() returns
+    return b"{" + b", ".join(b"\"%d\": %s" % (code, items[code]) for code in codes) + b"}"
+
+
+def get_obis_items(snapshot):
+    if snapshot is None:
+        return None
+    return snapshot.cached("obis_items", encode_obis_items)
+
+
+def render_obis_dump(snapshot, codes=None):
+    # JSON document of all OBIS datapoints of a snapshot (or only those in 'codes'),
+    # None if there are none. datapoints are encoded once per snapshot, requests
+    # only join them
+    items = get_obis_items(snapshot)
+    if items is None:
+        return None
+    if codes is None:
+        return snapshot.cached("obis_dump", lambda snapshot: join_obis_items(items, items))
+    return join_obis_items(items, codes)
+
+
+def get_version_etag(snapshot):
+    # OBIS data only changes with the snapshot, its version is a valid ETag
+    return '"v{}"'.format(snapshot.version)
+
+
+def get_ambiguous_meter_response(snapshots, version=None):
+    # without a meter id the latest message of any meter would be answered, so
+    # consecutive responses would switch between meters
+    body = json.dumps({"error": "Data of {} meters available, add a meter id (see /meters)".format(len(snapshots))}).encode()
+    return CachedResponse(version, 400, "application/json", body)
+
+
+def get_obis_response(path, args):
+    # answers /obis-dump[/<meter-id>] (optionally only '?codes=' given as comma
+    # separated internal names) and /obis/[<meter-id>/]<internal name> from the
+    # datapoints encoded once per snapshot. returns None for any other path
+    if path == "/obis-dump" or path.startswith("/obis-dump/"):
+        meter_id = path[len("/obis-dump/"):] or None
+        names = args.get("codes").split(",") if args.get("codes") else None
+    elif path.startswith("/obis/"):
+        meter_id, _, name = path[len("/obis/"):].rpartition("/")
+        meter_id = meter_id or None
+        names = [name]
+    else:
+        return None
+    codes = None
+    if names is not None:
+        unknown = [name for name in names if name not in obis.NAMES]
+        if unknown:
+            return CachedResponse(None, 400, "application/json", json.dumps({"error": "Unknown codes: {}".format(", ".join(unknown))}).encode())
+        codes = [obis.NAMES[name] for name in names]
+    snapshots = shared_sml_data.get_snapshots()
+    if meter_id is None and len(snapshots) > 1:
+        return get_ambiguous_meter_response(snapshots)
+    snapshot = shared_sml_data.get_snapshot(meter_id)
+    items = get_obis_items(snapshot)
+    if items is None:
+        # the combined dump has always been an empty document before the first message
+        status = 200 if meter_id is None and path.startswith("/obis-dump") else 404
+        return CachedResponse(None, status, "application/json", json.dumps({}).encode())
+    if path.startswith("/obis/"):
+        # single datapoints are polled the most, their responses are kept with the snapshot
+        code = codes[0]
+        return snapshot.cached(("obis_response", code), lambda snapshot: CachedResponse(
+            snapshot.version, 200, "application/json", items[code], get_version_etag(snapshot)))
+    return CachedResponse(snapshot.version, 200, "application/json", render_obis_dump(snapshot, codes), get_version_etag(snapshot))
+
+
+def render_meters(snapshots):
+    meters = {}
+    for meter_id, snapshot in snapshots.items():
+        meters[meter_id] = {
+            "version": snapshot.version,
+            "timestamp": snapshot.timestamp,
+        }
+    return json.dumps(meters)
+
 
 @app.route('/obis-dump')
-def api_obis_dump():
-    lock = threading.Lock()
-    with lock:
-        if shared_sml_data.SML_RAW_DATA is not None:
-            list_response = shared_sml_data.SML_RAW_DATA.GetRoot().GetListResponse()
-            if list_response is not None:
-                obis_data = sml.extract_obis_response_data(list_response)
-                return json.dumps(obis_data)
-    return json.dumps({})
+@app.route('/obis-dump/<meter_id>')
+@app.route('/obis/<internal_name>')
+@app.route('/obis/<meter_id>/<internal_name>')
+def api_obis_dump(meter_id=None, internal_name=None):
+    return make_cached_response(get_obis_response(request.path, request.args))
+
+
+@app.route('/meters')
+def api_meters():
+    return render_meters(shared_sml_data.get_snapshots())
+
+
+def get_meter_labels(obis_data):
+    manufacturer_data = obis_data[obis.CODE_MANUFACTURER]
+    manufacturer = manufacturer_data["value"] if manufacturer_data["value"] is not None else "unknown manufacturer"
+    
+    serial_data = obis_data[obis.CODE_SERIAL]
+    serial = serial_data["value"] if serial_data["value"] is not None else "unknown serial"
+    
+    serverid_data = obis_data[obis.CODE_ID]
+    serverid = serverid_data["value"].replace(" ","-") if serverid_data["value"] is not None else "unknown server-id"
+    return manufacturer, serial, serverid
+
+
+def render_prometheus_metrics(snapshots):
+    # Prometheus text exposition of all meters, empty if there is no OBIS data
+    output = []
+    meters = []
+    for meter_id, snapshot in sorted(snapshots.items(), key=lambda item: str(item[0])):
+        obis_data = sml.get_obis_data(snapshot)
+        if obis_data is not None:
+            labels = get_meter_labels(obis_data) + (shared_sml_data.get_meter_label(meter_id),)
+            meters.append((instrumentation.format_labels(OBIS_LABELS, labels), obis_data))
+    # every metric is announced once, followed by the samples of all meters
+    for code, item in obis.CODES.items():
+        if meters and item["type"] in [obis.TYPE_GAUGE, obis.TYPE_COUNTER]:
+            data_type = "gauge" if item["type"] == obis.TYPE_GAUGE else "counter"
+            unit = next((obis_data[code]["unit"] for _, obis_data in meters if obis_data[code]["unit"] is not None), None)
+            
+            output.append("# TYPE obis_{} {}\n".format(item["internal_name"], data_type))
+            output.append("# HELP obis_{} {}, Einheit {}\n".format(item["internal_name"], item["description"], unit))
+            for labels, obis_data in meters:
+                value = 0 if obis_data[code]["value"] is None else obis_data[code]["value"]
+                output.append("obis_{}{} {:.2f}\n".format(item["internal_name"], labels, value))
+    return "".join(output)
+
+
+# the latest rendered /metrics response, replaced once a newer snapshot is published
+# or its sml_reader_* metrics are older than READER_METRICS_INTERVAL seconds
+METRICS = None
+# (version, exposition) of the OBIS data, only rendered once per snapshot version
+OBIS_METRICS = (None, "")
+READER_METRICS_INTERVAL = 1.0
+# returns the sml_reader_* metrics, API workers get them from the reader process
+RENDER_READER_METRICS = instrumentation.render
+
+
+def get_prometheus_metrics():
+    # renders the exposition at most once per snapshot version (and once per
+    # READER_METRICS_INTERVAL), all scrapes in between are served from the cache.
+    # concurrent scrapes of a new version might both render it, which is cheaper
+    # than making them wait for each other
+    global METRICS, OBIS_METRICS
+    latest = shared_sml_data.get_snapshot()
+    version = latest.version if latest is not None else 0
+    metrics = METRICS
+    if metrics is None or metrics.version != version or time.monotonic() - metrics.created >= READER_METRICS_INTERVAL:
+        obis_version, output = OBIS_METRICS
+        if obis_version != version:
+            output = render_prometheus_metrics(shared_sml_data.get_snapshots())
+            OBIS_METRICS = (version, output)
+        if output:
+            metrics = CachedResponse(version, 200, PROMETHEUS_CONTENT_TYPE, (output + RENDER_READER_METRICS()).encode())
+        else:
+            metrics = CachedResponse(version, 500, "text/plain", b"No SML data (yet)")
+        METRICS = metrics
+    return metrics
+
+
+def make_cached_response(cached):
+    status, body, headers = cached.select(request.headers.get("If-None-Match", ""), request.headers.get("Accept-Encoding", ""))
+    return Response(body, status=status, headers=headers, content_type=cached.content_type)
 
 
 @app.route('/metrics')
 def api_prometheus_metrics():
-    output = ""
-    lock = threading.Lock()
-    with lock:
-        if shared_sml_data.SML_RAW_DATA is not None:
-            list_response = shared_sml_data.SML_RAW_DATA.GetRoot().GetListResponse()
-            if list_response is not None:
-                obis_data = sml.extract_obis_response_data(list_response)
-                manufacturer_data = obis_data[obis.CODE_MANUFACTURER]
-                manufacturer = manufacturer_data["value"] if manufacturer_data["value"] is not None else "unknown manufacturer"
-                
-                serial_data = obis_data[obis.CODE_SERIAL]
-                serial = serial_data["value"] if serial_data["value"] is not None else "unknown serial"
-                
-                serverid_data = obis_data[obis.CODE_ID]
-                serverid = serverid_data["value"].replace(" ","-") if serverid_data["value"] is not None else "unknown server-id"
-                for _, data in obis_data.items():
-                    if data["type"] in [obis.TYPE_GAUGE, obis.TYPE_COUNTER]:
-                        data_type = "gauge" if data["type"] == obis.TYPE_GAUGE else "counter"
-                        value = 0 if data["value"] is None else data["value"]
-                        
-                        output += "# TYPE obis_{} {}\n".format(data["internal_name"], data_type)
-                        output += "# HELP obis_{} {}, Einheit {}\n".format(data["internal_name"], data["description"], data["unit"])
-                        output += "obis_{}{{manufacturer=\"{}\",serial=\"{}\",serverid=\"{}\"}} {:.2f}\n".format(data["internal_name"], manufacturer, serial, serverid, value)
-    if output:
-        return Response(output, content_type="text/plain; version=0.0.4;charset=UTF-8")
+    return make_cached_response(get_prometheus_metrics())
+
+
+# history store range queries are answered from, None if no history is recorded
+HISTORY_STORE = None
+# upper limit of buckets a single range query may return
+MAX_HISTORY_POINTS = 11000
+
+
+def render_history_meters():
+    if HISTORY_STORE is None:
+        return 404, json.dumps({"error": "No history recorded"})
+    return 200, json.dumps(HISTORY_STORE.get_meters())
+
+
+def render_history_query(meter_id, args):
+    # range query over the recorded history of a meter, returns (status, JSON).
+    # 'args' holds the query parameters: codes (internal names, comma separated),
+    # start and end (unix time), step (seconds) and aggregations (min, max, avg, last)
+    if HISTORY_STORE is None:
+        return 404, json.dumps({"error": "No history recorded"})
+    if history.get_meter_directory_name(meter_id) not in HISTORY_STORE.get_meters():
+        return 404, json.dumps({"error": "No history recorded for meter {}".format(meter_id)})
+    try:
+        end = float(args.get("end") or time.time())
+        start = float(args.get("start") or end - 3600)
+        step = int(args.get("step") or 60)
+    except ValueError:
+        return 400, json.dumps({"error": "start, end and step need to be numbers"})
+    names = args.get("codes").split(",") if args.get("codes") else HISTORY_STORE.names
+    aggregations = args.get("aggregations").split(",") if args.get("aggregations") else ["avg"]
+    unknown = [name for name in names if name not in HISTORY_STORE.names] + [aggregation for aggregation in aggregations if aggregation not in history.AGGREGATIONS]
+    if unknown:
+        return 400, json.dumps({"error": "Unknown codes or aggregations: {}".format(", ".join(unknown))})
+    if step <= 0 or end <= start:
+        return 400, json.dumps({"error": "step needs to be positive and end after start"})
+    if (end - start) / step > MAX_HISTORY_POINTS:
+        return 400, json.dumps({"error": "Query would return more than {} points per series, increase step".format(MAX_HISTORY_POINTS)})
+    resolution, data = HISTORY_STORE.aggregate(meter_id, names, start, end, step, aggregations)
+    for series in data.values():
+        for aggregation, points in series.items():
+            # JSON has no NaN, missing values become null
+            series[aggregation] = [[bucket, None if math.isnan(value) else value] for bucket, value in points]
+    return 200, json.dumps({
+        "meter": meter_id,
+        "start": start,
+        "end": end,
+        "step": step,
+        "resolution": resolution or 0,
+        "data": data,
+    })
+
+
+@app.route('/history')
+def api_history_meters():
+    status, output = render_history_meters()
+    return Response(output, mimetype="application/json", status=status)
+
+
+@app.route('/history/<meter_id>')
+def api_history_query(meter_id):
+    status, output = render_history_query(meter_id, request.args)
+    return Response(output, mimetype="application/json", status=status)
+
+
+def start_api(bind_ip, bind_port, server="async", max_connections=1000, keep_alive_timeout=60, backlog=1024):
+    if server == "flask":
+        # Flask's development server, mostly useful for debugging
+        app.run(host=bind_ip, port=bind_port)
+    else:
+        asyncio.run(serve_async_api(bind_ip, bind_port, None, max_connections, keep_alive_timeout, backlog))
+
+
+# Server-Sent Events of the asyncio API (see EventStream)
+EVENT_CONTENT_TYPE = "text/event-stream"
+# events a client may fall behind before it skips to the latest snapshot
+EVENT_QUEUE_SIZE = 16
+# comment lines sent to idle clients, keeps proxies from closing the connection
+EVENT_KEEP_ALIVE_INTERVAL = 15
+
+
+def encode_event(name, version, data):
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(version, name, json.dumps(data)).encode()
+
+
+def get_changed_obis_data(previous, obis_data):
+    # datapoints whose value or unit differs from the previous snapshot of the meter
+    if previous is None:
+        return obis_data
+    changed = {}
+    for code, item in obis_data.items():
+        before = previous.get(code)
+        if before is None or before["value"] != item["value"] or before["unit"] != item["unit"]:
+            changed[code] = item
+    return changed
+
+
+class EventClient():
+    __slots__ = ("meter_id", "changes", "queue")
+
+    def __init__(self, meter_id, changes):
+        # 'meter_id' None subscribes to all meters
+        self.meter_id = meter_id
+        self.changes = changes
+        self.queue = asyncio.Queue(EVENT_QUEUE_SIZE)
+
+
+class EventStream():
+    # pushes every new snapshot to the subscribed clients. every event is encoded
+    # once per snapshot and shared by all clients: "snapshot" events hold all OBIS
+    # data of a meter, "changes" events only what changed since its previous snapshot.
+    # clients that fall behind by EVENT_QUEUE_SIZE events lose their pending events
+    # and get the latest snapshots of their meters instead, so they never hold up
+    # anybody else. all methods have to be called from the event loop
+    def __init__(self):
+        self.clients = set()
+        self.versions = {}
+        self.obis_data = {}
+        # latest "snapshot" event of every meter, sent to new and lagging clients
+        self.latest = {}
+
+    def subscribe(self, meter_id=None, changes=False):
+        client = EventClient(meter_id, changes)
+        self.resync(client)
+        self.clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        self.clients.discard(client)
+
+    def resync(self, client):
+        for meter_id, event in self.latest.items():
+            if (client.meter_id is None or client.meter_id == meter_id) and not client.queue.full():
+                client.queue.put_nowait(event)
+
+    def publish(self, snapshots):
+        # creates the events of all snapshots that have not been published yet
+        for meter_id, snapshot in sorted(snapshots.items(), key=lambda item: item[1].version):
+            if self.versions.get(meter_id) == snapshot.version:
+                continue
+            self.versions[meter_id] = snapshot.version
+            obis_data = sml.get_obis_data(snapshot)
+            if obis_data is None:
+                continue
+            data = {"meter": meter_id, "version": snapshot.version, "timestamp": snapshot.timestamp}
+            full = self.latest[meter_id] = encode_event("snapshot", snapshot.version, dict(data, data=obis_data))
+            changes = None
+            for client in self.clients:
+                if client.meter_id is not None and client.meter_id != meter_id:
+                    continue
+                if client.changes and changes is None:
+                    changes = encode_event("changes", snapshot.version, dict(data, data=get_changed_obis_data(self.obis_data.get(meter_id), obis_data)))
+                self.send(client, changes if client.changes else full)
+            self.obis_data[meter_id] = obis_data
+
+    def send(self, client, event):
+        queue = client.queue
+        if queue.full():
+            # drop what the client did not receive yet, the latest snapshots replace it
+            instrumentation.EVENTS_SKIPPED.inc((), queue.qsize())
+            while not queue.empty():
+                queue.get_nowait()
+            self.resync(client)
+            return
+        queue.put_nowait(event)
+
+    def get_client_count(self):
+        return {(): len(self.clients)}
+
+
+EVENT_STREAM = EventStream()
+instrumentation.Callback("sml_reader_event_clients", "gauge", "Number of clients subscribed to /events", EVENT_STREAM.get_client_count)
+
+
+def get_query_args(query):
+    # query parameters of the asyncio API, the last value wins
+    return {name: values[-1] for name, values in urllib.parse.parse_qs(query).items()}
+
+
+async def stream_events(writer, path, query):
+    # serves /events and /events/<meter-id> until the client disconnects.
+    # '?changes=1' only streams datapoints that changed after the first snapshot
+    meter_id = urllib.parse.unquote(path[len("/events/"):]) if path.startswith("/events/") else None
+    args = get_query_args(query)
+    changes = args.get("changes", "0") not in ("0", "false", "")
+    writer.write("HTTP/1.1 200 OK\r\nContent-Type: {}\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n".format(EVENT_CONTENT_TYPE).encode("latin-1"))
+    client = EVENT_STREAM.subscribe(meter_id, changes)
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(client.queue.get(), EVENT_KEEP_ALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                event = b": keep-alive\n\n"
+            writer.write(event)
+            # only this client waits for its socket, publish() never blocks
+            await writer.drain()
+    finally:
+        EVENT_STREAM.unsubscribe(client)
+
+
+# responses of the asyncio API (path -> CachedResponse). they are rendered once
+# per snapshot version, requests only look them up
+ASYNC_RESPONSES = {}
+ASYNC_VERSION = None
+# routes of the asyncio API that are rendered for every request (path prefix ->
+# function). they are called with the rest of the path and the query parameters
+# from a worker thread and return (status, JSON)
+ASYNC_ROUTES = {
+    "/history/": render_history_query,
+}
+ASYNC_STATUS_LINES = {
+    200: "200 OK",
+    304: "304 Not Modified",
+    400: "400 Bad Request",
+    404: "404 Not Found",
+    405: "405 Method Not Allowed",
+    500: "500 Internal Server Error",
+}
+
+
+def render_async_responses():
+    snapshots = shared_sml_data.get_snapshots()
+    metrics = get_prometheus_metrics()
+    version = metrics.version
+    responses = {"/metrics": metrics}
+    latest = shared_sml_data.get_snapshot()
+    obis_dump = render_obis_dump(latest) if len(snapshots) <= 1 else None
+    if obis_dump is not None:
+        responses["/obis-dump"] = CachedResponse(version, 200, "application/json", obis_dump, get_version_etag(latest))
+    elif len(snapshots) > 1:
+        responses["/obis-dump"] = get_ambiguous_meter_response(snapshots, version)
+    else:
+        responses["/obis-dump"] = CachedResponse(version, 200, "application/json", json.dumps({}).encode())
+    for meter_id, snapshot in snapshots.items():
+        obis_dump = render_obis_dump(snapshot)
+        if obis_dump is not None:
+            responses["/obis-dump/{}".format(meter_id)] = CachedResponse(version, 200, "application/json", obis_dump, get_version_etag(snapshot))
+    responses["/meters"] = CachedResponse(version, 200, "application/json", render_meters(snapshots).encode())
+    status, output = render_history_meters()
+    responses["/history"] = CachedResponse(version, status, "application/json", output.encode())
+    return responses
+
+
+async def get_async_route_response(path, query):
+    for prefix, render in ASYNC_ROUTES.items():
+        if path.startswith(prefix):
+            args = get_query_args(query)
+            loop = asyncio.get_running_loop()
+            status, output = await loop.run_in_executor(None, render, urllib.parse.unquote(path[len(prefix):]), args)
+            return CachedResponse(None, status, "application/json", output.encode())
+    return None
+
+
+def get_async_responses():
+    # responses are rendered again as soon as a newer snapshot shows up, so the
+    # server does not depend on being notified about new snapshots
+    global ASYNC_RESPONSES, ASYNC_VERSION
+    latest = shared_sml_data.get_snapshot()
+    version = latest.version if latest is not None else 0
+    if version != ASYNC_VERSION:
+        ASYNC_RESPONSES = render_async_responses()
+        ASYNC_VERSION = version
     else:
-        return Response("No SML data (yet)", mimetype="text/plain", status=500)
+        # /metrics also changes in between snapshots (sml_reader_* metrics)
+        metrics = get_prometheus_metrics()
+        if metrics is not ASYNC_RESPONSES.get("/metrics"):
+            responses = dict(ASYNC_RESPONSES)
+            responses["/metrics"] = metrics
+            ASYNC_RESPONSES = responses
+    return ASYNC_RESPONSES
+
+
+async def read_request_head(reader, keep_alive_timeout=None):
+    # returns (request line, headers) of the next request or None once the client
+    # closed the connection or was idle for 'keep_alive_timeout' seconds. raises
+    # ValueError if a line exceeds the limit of the StreamReader
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), keep_alive_timeout)
+    except asyncio.TimeoutError:
+        return None
+    if not request_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return request_line, headers
+
+
+async def handle_async_request(reader, writer, slots=None, keep_alive_timeout=None):
+    # minimal HTTP/1.1 server for GET requests with keep-alive support. 'slots' (a
+    # semaphore) limits how many connections are served at the same time, idle
+    # connections are closed after 'keep_alive_timeout' seconds
+    if slots is not None:
+        await slots.acquire()
+    try:
+        while True:
+            try:
+                request_head = await read_request_head(reader, keep_alive_timeout)
+            except (ValueError, asyncio.LimitOverrunError):
+                # oversized request line or header, it is answered with a 400 and
+                # the connection is closed (the rest of it would be read as a request)
+                request_head = (b"", {})
+            if request_head is None:
+                break
+            request_line, headers = request_head
+            extra_headers = {}
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                status, content_type, body = 400, "text/plain", b"Bad Request"
+                method, version = None, "HTTP/1.0"
+            else:
+                path, _, query = target.partition("?")
+                if method == "GET" and (path == "/events" or path.startswith("/events/")):
+                    # the connection is closed once the stream ends
+                    await stream_events(writer, path, query)
+                    break
+                response = None
+                if method == "GET" and (query and path.startswith("/obis-dump") or path.startswith("/obis/")):
+                    # subsets and single datapoints are joined from the datapoints of the snapshot
+                    response = get_obis_response(urllib.parse.unquote(path), get_query_args(query))
+                if response is None:
+                    response = get_async_responses().get(path)
+                if response is None and method == "GET":
+                    response = await get_async_route_response(path, query)
+                if method != "GET":
+                    status, content_type, body = 405, "text/plain", b"Method Not Allowed"
+                elif response is None:
+                    status, content_type, body = 404, "text/plain", b"Not Found"
+                else:
+                    content_type = response.content_type
+                    status, body, extra_headers = response.select(headers.get("if-none-match", ""), headers.get("accept-encoding", ""))
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            # request bodies are never read, the connection is closed instead of
+            # reading them as the next request
+            if method != "GET" or headers.get("content-length", "0") != "0" or "transfer-encoding" in headers:
+                keep_alive = False
+            head = "HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n".format(
+                ASYNC_STATUS_LINES[status], content_type, len(body), "keep-alive" if keep_alive else "close")
+            for name, value in extra_headers.items():
+                head += "{}: {}\r\n".format(name, value)
+            writer.write((head + "\r\n").encode("latin-1"))
+            writer.write(body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+        if slots is not None:
+            slots.release()
 
 
-def start_api(bind_ip, bind_port):
-    app.run(host=bind_ip, port=bind_port)
\ No newline at end of file
+async def serve_async_api(bind_ip, bind_port, queue=None, max_connections=None, keep_alive_timeout=None, backlog=100, reuse_port=False):
+    # serves the API from the event loop. new snapshots are picked up right away:
+    # responses are rendered and events are pushed to /events clients. if given,
+    # 'queue' receives newly published snapshots (asyncio mode), otherwise the
+    # publishing threads notify the event loop (see shared_sml_data.subscribe()).
+    # 'reuse_port' lets several processes bind to the same port
+    loop = asyncio.get_running_loop()
+    subscribed = queue is None
+    if subscribed:
+        queue = asyncio.Queue(maxsize=1)
+        shared_sml_data.subscribe(loop, queue)
+    try:
+        slots = asyncio.Semaphore(max_connections) if max_connections else None
+        handler = functools.partial(handle_async_request, slots=slots, keep_alive_timeout=keep_alive_timeout)
+        get_async_responses()
+        server = await asyncio.start_server(handler, bind_ip, bind_port, backlog=backlog, reuse_port=reuse_port or None)
+        logging.info("Serving HTTP API on {}:{} (at most {} connections)".format(bind_ip, bind_port, max_connections or "unlimited"))
+        async with server:
+            while True:
+                await queue.get()
+                get_async_responses()
+                EVENT_STREAM.publish(shared_sml_data.get_snapshots())
+    finally:
+        if subscribed:
+            shared_sml_data.unsubscribe(loop, queue)
\ No newline at end of file
@@ -0,0 +1,124 @@
+import bisect
+import threading
+
+# metrics about sml-reader itself, exposed as sml_reader_* series on /metrics next
+# to the OBIS data. updates only take a per metric lock, which is cheap compared to
+# reading or parsing a frame. all metrics register themselves in METRICS on creation
+
+METRICS = []
+
+# upper bounds (in seconds) of the processing stage histogram
+DURATION_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    labels = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        labels.append("{}=\"{}\"".format(name, value))
+    return "{" + ",".join(labels) + "}"
+
+
+class Counter():
+    # monotonically increasing value per combination of label values
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self, output):
+        with self.lock:
+            values = sorted(self.values.items())
+        if not values:
+            return
+        output.append("# TYPE {} counter\n".format(self.name))
+        output.append("# HELP {} {}\n".format(self.name, self.description))
+        for label_values, value in values:
+            output.append("{}{} {}\n".format(self.name, format_labels(self.labels, label_values), value))
+
+
+class Histogram():
+    # distribution of observed values (e.g. durations) in cumulative buckets
+    def __init__(self, name, description, buckets, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.labels = labels
+        # label values -> [bucket counts (the last one is +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, label_values=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(label_values)
+            if data is None:
+                data = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def render(self, output):
+        with self.lock:
+            values = [(label_values, list(data[0]), data[1], data[2]) for label_values, data in sorted(self.values.items())]
+        if not values:
+            return
+        output.append("# TYPE {} histogram\n".format(self.name))
+        output.append("# HELP {} {}\n".format(self.name, self.description))
+        labels = self.labels + ("le",)
+        for label_values, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                output.append("{}_bucket{} {}\n".format(self.name, format_labels(labels, label_values + (bound,)), cumulative))
+            output.append("{}_sum{} {}\n".format(self.name, format_labels(self.labels, label_values), total))
+            output.append("{}_count{} {}\n".format(self.name, format_labels(self.labels, label_values), count))
+
+
+class Callback():
+    # values maintained elsewhere, 'function' is called on every scrape and returns
+    # a dictionary of label values -> value
+    def __init__(self, name, metric_type, description, function, labels=()):
+        self.name = name
+        self.metric_type = metric_type
+        self.description = description
+        self.function = function
+        self.labels = labels
+        METRICS.append(self)
+
+    def render(self, output):
+        values = self.function()
+        if not values:
+            return
+        output.append("# TYPE {} {}\n".format(self.name, self.metric_type))
+        output.append("# HELP {} {}\n".format(self.name, self.description))
+        for label_values, value in sorted(values.items()):
+            output.append("{}{} {}\n".format(self.name, format_labels(self.labels, label_values), value))
+
+
+def render():
+    # Prometheus text exposition of all metrics
+    output = []
+    for metric in METRICS:
+        metric.render(output)
+    return "".join(output)
+
+
+SERIAL_READS = Counter("sml_reader_serial_reads_total", "Number of reads from the serial device", ("device",))
+SERIAL_BYTES = Counter("sml_reader_serial_bytes_total", "Number of bytes read from the serial device", ("device",))
+FRAMES = Counter("sml_reader_frames_total", "Number of complete SML frames received", ("device",))
+FRAME_ERRORS = Counter("sml_reader_frame_errors_total", "Number of dropped SML frames (checksum, incomplete, escape or parse errors)", ("device", "reason"))
+LAYOUTS = Counter("sml_reader_layout_cache_total", "Number of SML files read via the cached layout of previous files (hit) or parsed completely (miss)", ("device", "result"))
+SNAPSHOTS = Counter("sml_reader_snapshots_total", "Number of published SML files", ("meter",))
+EVENTS_SKIPPED = Counter("sml_reader_events_skipped_total", "Number of /events events dropped because a client could not keep up")
+DURATIONS = Histogram("sml_reader_stage_duration_seconds", "Processing time per SML file in each stage (read: per serial read, stream: scan and parse)", DURATION_BUCKETS, ("stage",))
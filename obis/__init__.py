@@ -185,10 +185,16 @@ CODES = {
 }
 
 
+# lookup table OBIS bytecode -> CODE_ variable, built once at import time
+INDEX = {code["bytes"]: code_id for code_id, code in CODES.items()}
+# lookup table internal_name -> CODE_ variable
+NAMES = {code["internal_name"]: code_id for code_id, code in CODES.items()}
+
+
 def BytesToString(byte_stream):
-    for code_id, code in CODES.items():
-        if code["bytes"] == byte_stream:
-            return code["description"]
+    code_id = INDEX.get(byte_stream)
+    if code_id is not None:
+        return CODES[code_id]["description"]
     return ""
 
 
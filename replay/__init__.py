@@ -0,0 +1,129 @@
+import collections
+import csv
+import itertools
+import logging
+import mmap
+import multiprocessing
+import os
+import time
+
+import sml
+import obis
+
+# decodes captured serial traffic (e.g. recorded with 'cat /dev/ttyUSB0 > capture.bin').
+# captures are split into frames with the same FrameScanner read_serial_data uses,
+# batches of frames are decoded by a pool of worker processes and the results are
+# written in the order of the capture
+
+# how much of a capture is handed to the frame scanner at once
+CHUNK_SIZE = 1 << 20
+# every column of the CSV output after the frame number and meter id
+CODES = list(obis.CODES.keys())
+# layout parser of a worker process, frames of one capture mostly share their layout
+LAYOUT_PARSER = None
+
+
+def read_frames(path, verify_crc=True):
+    # yields (message, footer) of every frame in a capture file
+    with open(path, "rb") as fin:
+        if os.fstat(fin.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as capture:
+            scanner = sml.FrameScanner(verify_crc)
+            for pos in range(0, len(capture), CHUNK_SIZE):
+                for msg, footer in scanner.feed(capture[pos:pos + CHUNK_SIZE]):
+                    yield bytes(msg), footer
+            if scanner.crc_errors:
+                logging.warning("Dropped {} frames of {} with checksum errors".format(scanner.crc_errors, path))
+
+
+def get_batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def decode_frame(msg, footer):
+    # returns (server id, OBIS data) of a frame or None if it carried no OBIS data
+    root = sml.parse_sml_bytestream(msg, footer)
+    if root is None:
+        return None
+    response = root.GetListResponse()
+    if response is None:
+        return None
+    return sml.get_server_id(root), sml.extract_obis_response_data(response)
+
+
+def decode_frames(frames, layout_cache=True):
+    # runs in the worker processes: 'frames' is a list of (frame number, message,
+    # footer), returns one row per frame that carried OBIS data
+    global LAYOUT_PARSER
+    if layout_cache and LAYOUT_PARSER is None:
+        LAYOUT_PARSER = sml.SML_Layout_Parser()
+    rows = []
+    for number, msg, footer in frames:
+        try:
+            if layout_cache:
+                parsed = LAYOUT_PARSER.parse(msg, footer)
+                decoded = parsed[1:] if parsed is not None and parsed[2] is not None else None
+            else:
+                decoded = decode_frame(msg, footer)
+        except Exception:
+            # a single broken frame (e.g. with --skip-crc-check) must not stop the replay
+            logging.exception("Could not decode frame {}, skipping it".format(number))
+            continue
+        if decoded is None:
+            continue
+        server_id, obis_data = decoded
+        rows.append([number, server_id] + [obis_data[code]["value"] for code in CODES])
+    return rows
+
+
+def get_header():
+    return ["frame", "meter"] + [obis.CODES[code]["internal_name"] for code in CODES]
+
+
+def replay(paths, output, processes=None, batch_size=256, verify_crc=True, layout_cache=True):
+    # writes the OBIS data of every frame in the capture files to 'output' (CSV).
+    # at most a few batches per worker are in flight, so memory usage does not
+    # depend on the size of the captures
+    start = time.perf_counter()
+    frames = (frame for path in paths for frame in read_frames(path, verify_crc))
+    batches = get_batches(((number,) + frame for number, frame in enumerate(frames)), batch_size)
+    writer = csv.writer(output)
+    writer.writerow(get_header())
+    frame_count = 0
+    row_count = 0
+    if processes == 1:
+        for batch in batches:
+            frame_count += len(batch)
+            rows = decode_frames(batch, layout_cache)
+            row_count += len(rows)
+            writer.writerows(rows)
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            pending = collections.deque()
+            limit = (processes or os.cpu_count() or 1) * 4
+            for batch in batches:
+                frame_count += len(batch)
+                pending.append(pool.apply_async(decode_frames, (batch, layout_cache)))
+                if len(pending) >= limit:
+                    rows = pending.popleft().get()
+                    row_count += len(rows)
+                    writer.writerows(rows)
+            while pending:
+                rows = pending.popleft().get()
+                row_count += len(rows)
+                writer.writerows(rows)
+    elapsed = time.perf_counter() - start
+    capture_bytes = sum(os.path.getsize(path) for path in paths)
+    return {
+        "frames": frame_count,
+        "rows": row_count,
+        "bytes": capture_bytes,
+        "seconds": elapsed,
+        "mb_per_second": capture_bytes / elapsed / 1e6 if elapsed else 0,
+    }
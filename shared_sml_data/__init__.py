@@ -1,6 +1,149 @@
+import threading
+import time
 
-# init shared variable 
-# SML/read thread will fill this variable with data, all other threads will read from it
-# you _must_ use threading.Lock() while accessing SML_DATA to ensure the integrity of the data
-SML_RAW_DATA = None
+import instrumentation
 
+# the SML/read threads publish every completely parsed SML file as an immutable,
+# versioned snapshot. there is one snapshot slot per meter (keyed by server id),
+# versions are counted across all meters. all other threads only read snapshots:
+# - get_snapshot() never blocks, the snapshot is swapped in with a single assignment
+# - get_snapshots() returns the latest snapshot of every meter (never modify it)
+# - wait_for_snapshot() blocks until a snapshot newer than a given version shows up
+# - subscribe() wakes up an event loop (of any thread) on every new snapshot
+# never modify the SML structure referenced by a snapshot
+
+
+class Snapshot():
+    __slots__ = ("version", "timestamp", "root", "meter_id", "_cache")
+
+    def __init__(self, version, root, meter_id=None, cache=None, timestamp=None):
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "timestamp", timestamp if timestamp is not None else time.time())
+        object.__setattr__(self, "root", root)
+        object.__setattr__(self, "meter_id", meter_id)
+        object.__setattr__(self, "_cache", dict(cache) if cache else {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot objects are immutable")
+
+    def __repr__(self):
+        return "{}: Snapshot: meter {}, version {}, timestamp {}".format(hex(id(self)), self.meter_id, self.version, self.timestamp)
+
+    def cached(self, key, factory):
+        # derive data from this snapshot only once and share it between all readers.
+        # concurrent readers might both run 'factory', but only one result is kept
+        try:
+            return self._cache[key]
+        except KeyError:
+            return self._cache.setdefault(key, factory(self))
+
+
+LATEST = None
+SNAPSHOTS = {}
+CONDITION = threading.Condition()
+# (event loop, asyncio.Queue) of all subscribers, replaced on every change
+SUBSCRIBERS = ()
+
+
+def publish(root, meter_id=None, cache=None):
+    # 'cache' seeds Snapshot.cached() with data the reader already derived (e.g. "obis_data")
+    global LATEST, SNAPSHOTS
+    start = time.perf_counter()
+    with CONDITION:
+        version = LATEST.version + 1 if LATEST is not None else 1
+        snapshot = Snapshot(version, root, meter_id, cache)
+        # copy on write, readers might be iterating over the current dictionary
+        snapshots = dict(SNAPSHOTS)
+        snapshots[meter_id] = snapshot
+        SNAPSHOTS = snapshots
+        LATEST = snapshot
+        CONDITION.notify_all()
+    notify_subscribers()
+    instrumentation.DURATIONS.observe(time.perf_counter() - start, ("publish",))
+    instrumentation.SNAPSHOTS.inc((get_meter_label(meter_id),))
+    return snapshot
+
+
+def import_snapshot(snapshot):
+    # makes a snapshot published by another process (see snapshot_ring) the latest
+    # one of its meter, keeping its version. such snapshots have no SML structure
+    global LATEST, SNAPSHOTS
+    with CONDITION:
+        snapshots = dict(SNAPSHOTS)
+        snapshots[snapshot.meter_id] = snapshot
+        SNAPSHOTS = snapshots
+        if LATEST is None or snapshot.version > LATEST.version:
+            LATEST = snapshot
+        CONDITION.notify_all()
+    notify_subscribers()
+
+
+def subscribe(loop, queue):
+    # 'queue' (an asyncio.Queue of 'loop' with maxsize 1) receives None whenever a
+    # snapshot is published by any thread. notifications that were not picked up
+    # yet are merged, so the loop never falls behind
+    global SUBSCRIBERS
+    with CONDITION:
+        SUBSCRIBERS = SUBSCRIBERS + ((loop, queue),)
+
+
+def unsubscribe(loop, queue):
+    global SUBSCRIBERS
+    with CONDITION:
+        SUBSCRIBERS = tuple(subscriber for subscriber in SUBSCRIBERS if subscriber != (loop, queue))
+
+
+def notify_queue(queue):
+    # runs in the event loop of the queue
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+
+def notify_subscribers():
+    for loop, queue in SUBSCRIBERS:
+        try:
+            loop.call_soon_threadsafe(notify_queue, queue)
+        except RuntimeError:
+            # the loop has been closed without unsubscribing (e.g. at shutdown)
+            pass
+
+
+def get_snapshot(meter_id=None):
+    # latest snapshot of the given meter or of any meter if meter_id is None
+    if meter_id is None:
+        return LATEST
+    return SNAPSHOTS.get(meter_id)
+
+
+def get_snapshots():
+    return SNAPSHOTS
+
+
+def wait_for_snapshot(version=0, timeout=None, meter_id=None):
+    # returns the latest snapshot (of the given meter) once it is newer than
+    # 'version' or None on timeout
+    def is_newer():
+        snapshot = get_snapshot(meter_id)
+        return snapshot is not None and snapshot.version > version
+    with CONDITION:
+        if CONDITION.wait_for(is_newer, timeout):
+            return get_snapshot(meter_id)
+    return None
+
+
+def get_meter_label(meter_id):
+    return meter_id if meter_id is not None else ""
+
+
+def get_snapshot_timestamps():
+    return {(get_meter_label(meter_id),): snapshot.timestamp for meter_id, snapshot in SNAPSHOTS.items()}
+
+
+def get_snapshot_ages():
+    now = time.time()
+    return {(get_meter_label(meter_id),): now - snapshot.timestamp for meter_id, snapshot in SNAPSHOTS.items()}
+
+
+instrumentation.Callback("sml_reader_snapshot_timestamp_seconds", "gauge", "Time the latest SML file of a meter was published (unix time)", get_snapshot_timestamps, ("meter",))
+instrumentation.Callback("sml_reader_snapshot_age_seconds", "gauge", "Seconds since the latest SML file of a meter was published", get_snapshot_ages, ("meter",))
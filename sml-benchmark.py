@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import argparse
+import logging
+import sys
+
+import benchmark
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=1000, help="Number of SML frames to replay per round")
+    parser.add_argument("--rounds", type=int, default=5, help="Number of rounds per benchmark (best round is reported)")
+    parser.add_argument("--baudrates", type=int, nargs="+", default=[9600, 115200, 921600], help="Baudrates to replay captured traffic at")
+    parser.add_argument("--meter-models", type=str, nargs="+", default=list(benchmark.METERS), choices=list(benchmark.METERS), help="Meter models whose SML frames are parsed")
+    parser.add_argument("--meters", type=int, default=4, help="Number of meters to serve /metrics for")
+    parser.add_argument("--requests", type=int, default=2000, help="Number of /metrics requests")
+    parser.add_argument("--concurrency", type=int, default=10, help="Number of concurrent HTTP connections")
+    parser.add_argument("--event-clients", type=int, default=1000, help="Number of /events clients to push snapshots to")
+    parser.add_argument("--clients", type=int, default=128, help="Number of concurrent clients of the latency benchmark")
+    parser.add_argument("--servers", type=str, nargs="+", default=["async"], choices=["async", "flask"], help="HTTP API servers to measure latency of")
+    parser.add_argument("--latency-frames", type=int, default=200, help="Number of frames to measure end-to-end latency with")
+    parser.add_argument("--mqtt-host", type=str, default=None, help="Measure MQTT publish throughput against this broker")
+    parser.add_argument("--mqtt-port", type=int, default=1883, help="Port of the MQTT broker")
+    parser.add_argument("--json", type=str, default=None, help="Write all results to this file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare results to a file written with --json (exits with 1 on regressions)")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change for the worse that counts as a regression")
+    return parser.parse_args()
+
+
+def add_metric(metrics, name, value, unit, better):
+    metrics[name] = {"value": value, "unit": unit, "better": better}
+
+
+def print_scanner_results(results, metrics):
+    print("Frame scanner throughput")
+    for result in results:
+        print(" {:>7} baud (chunks of {:>3} bytes): {:>8.2f} MB/s, {:>6.2%} of one core at line rate".format(
+            result["baudrate"], result["chunk_size"], result["mb_per_second"], result["cpu_share"]))
+        add_metric(metrics, "scanner.{}.mb_per_second".format(result["baudrate"]), result["mb_per_second"], "MB/s", "higher")
+    print()
+
+
+def print_parser_results(meter, results, metrics):
+    print("Parser throughput (parse + OBIS extraction, {})".format(meter))
+    for result in results:
+        print(" {:>5}: {:>9.0f} frames/s".format(result["mode"], result["frames_per_second"]))
+        add_metric(metrics, "parser.{}.{}.frames_per_second".format(meter, result["mode"]), result["frames_per_second"], "frames/s", "higher")
+    print()
+
+
+def print_decoder_results(meter, results, metrics):
+    print("Decoded SML elements ({})".format(meter))
+    for result in results:
+        print(" {:>5}: {:>9.0f} elements/s".format(result["mode"], result["elements_per_second"]))
+        add_metric(metrics, "decoder.{}.{}.elements_per_second".format(meter, result["mode"]), result["elements_per_second"], "elements/s", "higher")
+    print()
+
+
+def print_function_results(meter, results, metrics):
+    print("Function calls ({})".format(meter))
+    for result in results:
+        print(" {:>26}: {:>9.0f} ns/call".format(result["function"], result["ns_per_call"]))
+        add_metric(metrics, "functions.{}.{}.ns_per_call".format(meter, result["function"]), result["ns_per_call"], "ns", "lower")
+    print()
+
+
+def print_crc_results(result, metrics):
+    print("Checksum verification ({} frames)".format(result["frames"]))
+    print(" CRC-16: {:.1f} us/frame, parsing: {:.1f} us/frame ({:.1%} of parse cost)".format(
+        result["crc_us_per_frame"], result["parse_us_per_frame"], result["crc_share"]))
+    add_metric(metrics, "crc.us_per_frame", result["crc_us_per_frame"], "us", "lower")
+    print()
+
+
+def print_memory_results(meter, result, metrics):
+    print("Parser memory per frame ({}, {} frames of {:.0f} bytes)".format(meter, result["frames"], result["frame_bytes"]))
+    print(" retained: {:.0f} bytes in {:.1f} blocks".format(result["retained_bytes_per_frame"], result["retained_blocks_per_frame"]))
+    print(" allocated while parsing: {:.0f} bytes".format(result["transient_bytes_per_frame"]))
+    print(" peak while parsing all frames: {} bytes, garbage collections: {}".format(result["peak_bytes"], result["gc_collections"]))
+    add_metric(metrics, "memory.{}.retained_bytes_per_frame".format(meter), result["retained_bytes_per_frame"], "bytes", "lower")
+    add_metric(metrics, "memory.{}.retained_blocks_per_frame".format(meter), result["retained_blocks_per_frame"], "blocks", "lower")
+    add_metric(metrics, "memory.{}.transient_bytes_per_frame".format(meter), result["transient_bytes_per_frame"], "bytes", "lower")
+    print()
+
+
+def print_ring_results(result, metrics):
+    print("Snapshot ring ({} records)".format(result["records"]))
+    print(" {:>8.0f} writes/s, {:>8.0f} reads/s".format(result["writes_per_second"], result["reads_per_second"]))
+    add_metric(metrics, "ring.writes_per_second", result["writes_per_second"], "records/s", "higher")
+    add_metric(metrics, "ring.reads_per_second", result["reads_per_second"], "records/s", "higher")
+    print()
+
+
+def print_events_results(result, metrics):
+    print("/events push ({} clients)".format(result["clients"]))
+    print(" {:.1f} us per frame".format(result["us_per_frame"]))
+    add_metric(metrics, "events.us_per_frame", result["us_per_frame"], "us", "lower")
+    print()
+
+
+def print_metrics_results(meter_count, results, metrics):
+    print("/metrics scrapes ({} meters)".format(meter_count))
+    for result in results:
+        print(" {:>9}: {:>9.0f} requests/s".format(result["mode"], result["requests_per_second"]))
+        add_metric(metrics, "metrics.{}.requests_per_second".format(result["mode"].replace(" ", "_")), result["requests_per_second"], "requests/s", "higher")
+    print()
+
+
+def print_obis_dump_results(meter_count, results, metrics):
+    print("/obis-dump requests ({} meters)".format(meter_count))
+    for result in results:
+        print(" {:>11}: {:>9.0f} requests/s".format(result["mode"], result["requests_per_second"]))
+        add_metric(metrics, "obis_dump.{}.requests_per_second".format(result["mode"].replace(" ", "_")), result["requests_per_second"], "requests/s", "higher")
+    print()
+
+
+def print_latency_results(results, metrics):
+    print("HTTP API latency (/metrics)")
+    for result in results:
+        print(" {:>5}: {} clients, {:>7.0f} requests/s, p50 {:>7.2f} ms, p99 {:>7.2f} ms".format(
+            result["server"], result["clients"], result["requests_per_second"], result["p50_ms"], result["p99_ms"]))
+        add_metric(metrics, "api.{}.p50_ms".format(result["server"]), result["p50_ms"], "ms", "lower")
+        add_metric(metrics, "api.{}.p99_ms".format(result["server"]), result["p99_ms"], "ms", "lower")
+    print()
+
+
+def print_end_to_end_results(results, metrics):
+    print("End-to-end latency (last byte of a frame to /metrics response)")
+    for result in results:
+        print(" {:>6}: {} frames, p50 {:>6.2f} ms, p99 {:>6.2f} ms, max {:>6.2f} ms".format(
+            result["meter"], result["frames"], result["p50_ms"], result["p99_ms"], result["max_ms"]))
+        add_metric(metrics, "end_to_end.{}.p50_ms".format(result["meter"]), result["p50_ms"], "ms", "lower")
+        add_metric(metrics, "end_to_end.{}.p99_ms".format(result["meter"]), result["p99_ms"], "ms", "lower")
+    print()
+
+
+def print_mqtt_results(results, metrics):
+    print("MQTT publishing")
+    for result in results:
+        print(" {:>6}: {:>8.0f} snapshots/s queued, {:>8.0f} messages/s sent ({} messages)".format(
+            result["mode"], result["snapshots_per_second"], result["messages_per_second"], result["messages"]))
+        add_metric(metrics, "mqtt.{}.snapshots_per_second".format(result["mode"]), result["snapshots_per_second"], "snapshots/s", "higher")
+        add_metric(metrics, "mqtt.{}.messages_per_second".format(result["mode"]), result["messages_per_second"], "messages/s", "higher")
+    print()
+
+
+def print_comparison(changes, tolerance):
+    print("Changes compared to baseline (regression: more than {:.0%} worse)".format(tolerance))
+    for name, before, value, change, regression in changes:
+        print(" {:<60} {:>12.2f} -> {:>12.2f} {:>+8.1%}{}".format(name, before, value, change, "  REGRESSION" if regression else ""))
+    print()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.WARNING, format="[%(levelname)s] [%(threadName)s] %(message)s")
+    metrics = {}
+    print_scanner_results(benchmark.benchmark_scanner(args.baudrates, args.frames, args.rounds), metrics)
+    for meter in args.meter_models:
+        print_parser_results(meter, benchmark.benchmark_parser(args.frames, args.rounds, meter), metrics)
+        print_decoder_results(meter, benchmark.benchmark_decoder(args.frames, args.rounds, meter), metrics)
+        print_function_results(meter, benchmark.benchmark_functions(args.frames, args.rounds, meter), metrics)
+        print_memory_results(meter, benchmark.benchmark_parser_memory(args.frames, meter), metrics)
+    print_crc_results(benchmark.benchmark_crc(args.frames, args.rounds), metrics)
+    print_ring_results(benchmark.benchmark_ring(args.frames, args.rounds), metrics)
+    print_events_results(benchmark.benchmark_events(args.event_clients), metrics)
+    print_metrics_results(args.meters, benchmark.benchmark_metrics(args.meters, args.requests, args.concurrency), metrics)
+    print_obis_dump_results(args.meters, benchmark.benchmark_obis_dump(args.meters, args.requests, args.concurrency), metrics)
+    print_latency_results(benchmark.benchmark_api_latency(args.servers, args.meters, args.clients), metrics)
+    print_end_to_end_results([benchmark.benchmark_end_to_end(args.latency_frames, meter) for meter in args.meter_models], metrics)
+    if args.mqtt_host is not None:
+        print_mqtt_results(benchmark.benchmark_mqtt(args.mqtt_host, args.mqtt_port, args.frames), metrics)
+
+    if args.json is not None:
+        benchmark.save_results(args.json, metrics)
+    if args.compare is not None:
+        changes = benchmark.compare_results(benchmark.load_results(args.compare), metrics, args.tolerance)
+        print_comparison(changes, args.tolerance)
+        if any(regression for _, _, _, _, regression in changes):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
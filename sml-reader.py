@@ -1,22 +1,35 @@
 #!/usr/bin/python3
 
 import argparse
+import asyncio
+import atexit
 import logging
 import pprint
+import signal
+import sys
 import threading
 
 import debug
 import http_api
+import history
 import obis
 import shared_sml_data
 import sml
+import sml_async
 import sml_mqtt
+import snapshot_ring
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--device", type=str, default="/dev/ttyUSB0", help="Set serial device to use")
+    parser.add_argument("--device", type=str, action="append", default=None, help="Set serial device to use (repeat to read several meters, defaults to /dev/ttyUSB0)")
+    parser.add_argument("--devices-file", type=str, default=None, help="Read serial devices from a file (one device per line, optionally followed by its baudrate)")
     parser.add_argument("--baudrate", type=int, default=9600, help="Set baudrate to use")
+    parser.add_argument("--lazy-parse", default=False, action="store_true", help="Only decode SML values when they are read and skip unused message bodies")
+    parser.add_argument("--stream-parse", default=False, action="store_true", help="Parse SML elements as soon as they arrive instead of waiting for complete messages (ignores --lazy-parse)")
+    parser.add_argument("--skip-layout-cache", default=False, action="store_true", help="Parse every SML message completely instead of reading values of known message layouts directly")
+    parser.add_argument("--skip-crc-check", default=False, action="store_true", help="Do not verify the checksum of received SML messages")
+    parser.add_argument("--asyncio", default=False, action="store_true", help="Run readers and publishers in a single asyncio event loop instead of threads (implies --stream-parse)")
     parser.add_argument("--dump-file", type=str, default=None, help="Regularly dump SML structures/messages to a file")
     parser.add_argument("--dump-file-interval", type=int, default=10, help="How often should the SML data be dumped to file")
     parser.add_argument("--dump-console", default=False, action="store_true", help="Regularly dump OBIS data to console (if present in last SML reading)")
@@ -24,10 +37,44 @@ def parse_arguments():
     parser.add_argument("--mqtt-host", type=str, default=None, help="Set hostname/ip address of mqtt broker to connect to")
     parser.add_argument("--mqtt-port", type=int, default=1883, help="Set port of mqtt broker to connect to")
     parser.add_argument("--mqtt-interval", type=int, default=30, help="How often should OBIS data be published to MQTT")
+    parser.add_argument("--mqtt-on-change", default=False, action="store_true", help="Publish OBIS data to MQTT as soon as it changes instead of every --mqtt-interval seconds")
+    parser.add_argument("--mqtt-threshold", type=float, default=0.0, help="Only publish values that changed by more than this (with --mqtt-on-change)")
+    parser.add_argument("--mqtt-refresh-interval", type=int, default=300, help="How often should all OBIS data be published regardless of changes (with --mqtt-on-change)")
+    parser.add_argument("--mqtt-qos", type=int, default=0, choices=[0, 1, 2], help="QoS level of published MQTT messages")
+    parser.add_argument("--mqtt-queue-size", type=int, default=10000, help="How many MQTT messages should be kept while the broker is unreachable")
+    parser.add_argument("--mqtt-spool-file", type=str, default=None, help="Spill MQTT messages that do not fit into the queue to this file instead of dropping them")
+    parser.add_argument("--mqtt-json", default=False, action="store_true", help="Publish all OBIS data of a meter as one JSON message instead of one message per value")
+    parser.add_argument("--history-dir", type=str, default=None, help="Record the history of all OBIS values to segment files in this directory")
+    parser.add_argument("--history-segment-duration", type=int, default=86400, help="Start a new history segment every n seconds (at most 49 days)")
+    parser.add_argument("--history-flush-interval", type=int, default=60, help="How often should recorded history be written to disk (in seconds)")
     parser.add_argument("--api-bind-ip", type=str, default="127.0.0.1", help="Bind HTTP API to this IP (0.0.0.0 binds to all available addresses)")
     parser.add_argument("--api-bind-port", type=int, default=5000, help="Bind HTTP API to this port")
+    parser.add_argument("--api-server", type=str, default="async", choices=["async", "flask"], help="Serve the HTTP API with the built-in asyncio server or Flask's development server")
+    parser.add_argument("--api-max-connections", type=int, default=1000, help="How many HTTP connections should be served at the same time (async server)")
+    parser.add_argument("--api-keep-alive-timeout", type=int, default=60, help="Close idle HTTP connections after this many seconds (async server)")
+    parser.add_argument("--api-workers", type=int, default=0, help="Serve the HTTP API from this many worker processes that read snapshots from shared memory (async server only)")
+    parser.add_argument("--api-backlog", type=int, default=1024, help="How many HTTP connections may wait to be accepted (async server)")
     parser.add_argument("--debug", default=False, action="store_true", help="Enable debug output")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not 0 < args.history_segment_duration <= history.MAX_SEGMENT_DURATION:
+        parser.error("--history-segment-duration must be between 1 and {} seconds".format(history.MAX_SEGMENT_DURATION))
+    return args
+
+
+def get_devices(args):
+    # returns a list of (device, baudrate) tuples
+    devices = [(device, args.baudrate) for device in args.device or []]
+    if args.devices_file is not None:
+        with open(args.devices_file) as fin:
+            for line in fin:
+                fields = line.split("#", 1)[0].split()
+                if not fields:
+                    continue
+                baudrate = int(fields[1]) if len(fields) > 1 else args.baudrate
+                devices.append((fields[0], baudrate))
+    if not devices:
+        devices.append(("/dev/ttyUSB0", args.baudrate))
+    return devices
 
 
 def main():
@@ -38,9 +85,30 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO, format=log_format)
 
-    sml_reader = threading.Thread(name="SerialReader", target=sml.read_serial_data, args=(args.device, args.baudrate,), daemon=True)
-    logging.info("Starting SML reader thread")
-    sml_reader.start()
+    # exit normally on SIGTERM (e.g. systemd), so atexit handlers run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    devices = get_devices(args)
+    ring_writer = None
+    if args.api_workers > 0:
+        # started before any other thread, workers serve the API in place of the API thread
+        ring_writer = snapshot_ring.RingWriter()
+        atexit.register(ring_writer.close)
+        snapshot_ring.start_workers(ring_writer.name, args.api_workers, args.api_bind_ip, args.api_bind_port, args.api_max_connections, args.api_keep_alive_timeout, args.api_backlog, args.history_dir)
+    if args.asyncio:
+        asyncio.run(sml_async.run(args, devices, ring_writer))
+        return
+
+    sml_readers = []
+    for index, (device, baudrate) in enumerate(devices):
+        name = "SerialReader" if len(devices) == 1 else "SerialReader-{}".format(index)
+        if args.stream_parse:
+            sml_reader = threading.Thread(name=name, target=sml.stream_serial_data, args=(device, baudrate, not args.skip_crc_check), daemon=True)
+        else:
+            sml_reader = threading.Thread(name=name, target=sml.read_serial_data, args=(device, baudrate, args.lazy_parse, not args.skip_crc_check, not args.skip_layout_cache), daemon=True)
+        logging.info("Starting SML reader thread for {} ({} baud)".format(device, baudrate))
+        sml_reader.start()
+        sml_readers.append(sml_reader)
 
     if args.dump_file is not None:
         logging.info("Starting periodic file dump thread (dumping every {} seconds)".format(args.dump_file_interval))
@@ -53,15 +121,35 @@ def main():
         obis_dumper.start()
     
     if args.mqtt_host is not None:
+        mqtt_client = sml_mqtt.connect(args.mqtt_host, args.mqtt_port, args.mqtt_qos, args.mqtt_queue_size, args.mqtt_spool_file, args.mqtt_json)
+    if args.mqtt_host is not None and args.mqtt_on_change:
+        logging.info("Starting mqtt publishing thread (publishing changes, all data every {} seconds)".format(args.mqtt_refresh_interval))
+        mqtt_publisher = threading.Thread(name="MqttPublisher", target=sml_mqtt.start_mqtt_on_change, args=(mqtt_client, args.mqtt_threshold, args.mqtt_refresh_interval), daemon=True)
+        mqtt_publisher.start()
+    elif args.mqtt_host is not None:
         logging.info("Starting mqtt publishing thread (publishing every {} seconds)".format(args.mqtt_interval))
-        mqtt_publisher = threading.Thread(name="MqttPublisher", target=sml_mqtt.start_mqtt, args=(args.mqtt_host, args.mqtt_port, args.mqtt_interval), daemon=True)
+        mqtt_publisher = threading.Thread(name="MqttPublisher", target=sml_mqtt.start_mqtt, args=(mqtt_client, args.mqtt_interval), daemon=True)
         mqtt_publisher.start()
 
-    logging.info("Starting API thread")
-    api_thread = threading.Thread(name="HttpApi", target=http_api.start_api, args=(args.api_bind_ip, args.api_bind_port), daemon=True)
-    api_thread.start()
+    if args.history_dir is not None:
+        logging.info("Starting history thread (recording to {}, writing every {} seconds)".format(args.history_dir, args.history_flush_interval))
+        history_store = history.HistoryStore(args.history_dir, args.history_segment_duration, args.history_flush_interval)
+        atexit.register(history_store.close)
+        http_api.HISTORY_STORE = history_store
+        history_recorder = threading.Thread(name="HistoryRecorder", target=history.start_history, args=(history_store,), daemon=True)
+        history_recorder.start()
+
+    if ring_writer is not None:
+        logging.info("Starting snapshot ring thread")
+        ring_thread = threading.Thread(name="SnapshotRing", target=snapshot_ring.start_ring_writer, args=(ring_writer,), daemon=True)
+        ring_thread.start()
+    else:
+        logging.info("Starting API thread")
+        api_thread = threading.Thread(name="HttpApi", target=http_api.start_api, args=(args.api_bind_ip, args.api_bind_port, args.api_server, args.api_max_connections, args.api_keep_alive_timeout, args.api_backlog), daemon=True)
+        api_thread.start()
     
-    sml_reader.join()
+    for sml_reader in sml_readers:
+        sml_reader.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+
+import argparse
+import logging
+import sys
+
+import replay
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("captures", type=str, nargs="+", help="Files with captured serial traffic, decoded in the given order")
+    parser.add_argument("--output", type=str, default=None, help="Write CSV output to this file instead of STDOUT")
+    parser.add_argument("--processes", type=int, default=None, help="Number of decoder processes (defaults to the number of CPUs, 1 decodes in the main process)")
+    parser.add_argument("--batch-size", type=int, default=256, help="Number of frames handed to a decoder process at once")
+    parser.add_argument("--skip-crc-check", default=False, action="store_true", help="Do not verify the SML transport checksum")
+    parser.add_argument("--skip-layout-cache", default=False, action="store_true", help="Parse every frame completely instead of reading values of known frame layouts directly")
+    parser.add_argument("--debug", default=False, action="store_true", help="Enable debug output")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    log_format = "[%(levelname)s] [%(processName)s] %(message)s"
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format=log_format)
+    else:
+        logging.basicConfig(level=logging.WARNING, format=log_format)
+
+    if args.output is None:
+        stats = replay.replay(args.captures, sys.stdout, args.processes, args.batch_size, not args.skip_crc_check, not args.skip_layout_cache)
+    else:
+        with open(args.output, "w", newline="") as fout:
+            stats = replay.replay(args.captures, fout, args.processes, args.batch_size, not args.skip_crc_check, not args.skip_layout_cache)
+    print("Decoded {} frames ({} with OBIS data) from {:.1f} MB in {:.2f} seconds ({:.2f} MB/s)".format(
+        stats["frames"], stats["rows"], stats["bytes"] / 1e6, stats["seconds"], stats["mb_per_second"]), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,26 @@
 
+import binascii
 import logging
+import operator
 import serial
-import threading
 import select
+import time
 
+import instrumentation
 import obis
 import shared_sml_data
 import utils
 
-LISTS = []
-
 ESCAPE_SEQ =b"\x1b\x1b\x1b\x1b" 
 START_SEQ = ESCAPE_SEQ + b"\x01\x01\x01\x01"
 END_SEQ = b"\x1b\x1b\x1b\x1b\x1a"
 
+# SML transport checksum: CRC-16/X.25 (reflected CCITT polynomial). binascii.crc_hqx
+# implements the non-reflected variant in C, so the data is bit-reversed on the way in
+# (bytes.translate) and the result on the way out. this avoids a python loop per byte
+BIT_REVERSED = bytes(int("{:08b}".format(value)[::-1], 2) for value in range(256))
+CRC_INIT = 0xFFFF
+
 MASK_EXTENDED_TYPE = 0x80
 MASK_TYPE = 0x70
 MASK_LENGTH = 0x0F
@@ -23,16 +30,44 @@ TYPE_OCTET_STRING = 0x00
 TYPE_SIGNED_INT = 0x50
 TYPE_UNSIGNED_INT = 0x60
 TYPE_BOOL = 0x40
+# not an SML type, the field type of the end of message marker 0x00 in TL_TABLE
+TYPE_END_OF_MESSAGE = -1
+
+
+def get_tl_entry(tl):
+    # (field type, length) of a TL byte, the length is None if more TL bytes follow
+    if tl == 0x00:
+        return TYPE_END_OF_MESSAGE, 0
+    if tl & MASK_EXTENDED_TYPE:
+        return tl & MASK_TYPE, None
+    return tl & MASK_TYPE, tl & MASK_LENGTH
+
+
+# every possible TL byte decoded once, so the parsers need a single lookup per element
+TL_TABLE = tuple(get_tl_entry(tl) for tl in range(256))
+
+
+class SML_Parse_Error(ValueError):
+    # malformed SML file (unknown field type, list with too many elements), the
+    # parsers drop such files like those with a wrong checksum
+    pass
+
+# events emitted by SML_Stream_Parser.feed() as (event, payload) tuples
+EVENT_FRAME_START = "frame_start"
+EVENT_MESSAGE_START = "message_start"
+EVENT_LIST_VALUE = "list_value"
+EVENT_END_OF_MESSAGE = "end_of_message"
+EVENT_FRAME_END = "frame_end"
+
+# body types that are parsed in lazy mode, all other message bodies are skipped
+LAZY_BODY_TYPES = (0x0701,)
 
 class SML_Octet_String():
-    length = 0
-    data = None
-    parent = None
-    
-    def __init__(self, length, data, parent):
+    __slots__ = ("length", "data")
+
+    def __init__(self, length, data):
         self.length = length
         self.data = data
-        self.parent = parent
     
     def __repr__(self):
         obis_str = obis.BytesToString(self.data)
@@ -42,47 +77,119 @@ class SML_Octet_String():
 
 
 class SML_Signed_Integer():
-    length = 0
-    data = None
-    parent = None
-    
-    def __init__(self, length, data, parent):
+    __slots__ = ("length", "data")
+
+    def __init__(self, length, data):
         self.length = length
         self.data = data
-        self.parent = parent
     
     def __repr__(self):
         return "{}: SML Signed Int: {}".format(hex(id(self)), self.data)
 
 
 class SML_Unsigned_Integer():
-    length = 0
-    data = None
-    parent = None
-    
-    def __init__(self, length, data, parent):
+    __slots__ = ("length", "data")
+
+    def __init__(self, length, data):
         self.length = length
         self.data = data
-        self.parent = parent
     
     def __repr__(self):
         return "{}: SML Unsigned Int: {}".format(hex(id(self)), self.data)
 
 
+# lazy variants of the leaf elements keep a reference to the message buffer and
+# decode their value the first time 'data' is read (see parse_sml_bytestream)
+class SML_Lazy_Octet_String(SML_Octet_String):
+    __slots__ = ("_buffer", "_offset")
+
+    def __init__(self, length, buffer, offset):
+        self.length = length
+        self._buffer = buffer
+        self._offset = offset
+
+    @property
+    def data(self):
+        # snapshots are read by several threads, another one might decode the value
+        # meanwhile. 'data' is always set before the buffer is dropped
+        buffer = self._buffer
+        if buffer is not None:
+            SML_Octet_String.data.__set__(self, bytes(buffer[self._offset:self._offset + self.length - 1]))
+            self._buffer = None
+        return SML_Octet_String.data.__get__(self)
+
+
+class SML_Lazy_Signed_Integer(SML_Signed_Integer):
+    __slots__ = ("_buffer", "_offset")
+
+    def __init__(self, length, buffer, offset):
+        self.length = length
+        self._buffer = buffer
+        self._offset = offset
+
+    @property
+    def data(self):
+        buffer = self._buffer
+        if buffer is not None:
+            int_buf = buffer[self._offset:self._offset + self.length - 1]
+            SML_Signed_Integer.data.__set__(self, int.from_bytes(int_buf, byteorder="big", signed=True))
+            self._buffer = None
+        return SML_Signed_Integer.data.__get__(self)
+
+
+class SML_Lazy_Unsigned_Integer(SML_Unsigned_Integer):
+    __slots__ = ("_buffer", "_offset")
+
+    def __init__(self, length, buffer, offset):
+        self.length = length
+        self._buffer = buffer
+        self._offset = offset
+
+    @property
+    def data(self):
+        buffer = self._buffer
+        if buffer is not None:
+            uint_buf = buffer[self._offset:self._offset + self.length - 1]
+            SML_Unsigned_Integer.data.__set__(self, int.from_bytes(uint_buf, byteorder="big", signed=False))
+            self._buffer = None
+        return SML_Unsigned_Integer.data.__get__(self)
+
+
+class SML_Boolean():
+    __slots__ = ("length", "data")
+
+    def __init__(self, length, data):
+        self.length = length
+        self.data = data
+
+    def __repr__(self):
+        return "{}: SML Boolean: {}".format(hex(id(self)), self.data)
+
+
 class SML_End_of_Message():
-    parent = None
-    
-    def __init__(self, parent):
-        self.parent = None
+    __slots__ = ()
     
     def __repr__(self):
         return "{}: SML End-of-Message Element".format(hex(id(self)))
 
 
+class SML_Skipped_Element():
+    # placeholder for a subtree that has not been parsed (lazy mode)
+    __slots__ = ("offset", "end")
+
+    def __init__(self, offset, end):
+        self.offset = offset
+        self.end = end
+
+    def __repr__(self):
+        return "{}: SML Skipped Element: {} bytes".format(hex(id(self)), self.end - self.offset)
+
+
 class SML_Structure():
-    parent = None
-    length = None
-    children = []
+    # only structures keep a reference to their parent, leaf elements
+    # are referenced by their structure only. the SML type of a structure is
+    # determined once by the parser (see SML_File.AddMessageBody)
+    __slots__ = ("parent", "length", "children", "structure_type")
     BODY_TYPES = {
         0x0100: "Open.Request",
         0x0101: "Open.Response",
@@ -107,10 +214,11 @@ class SML_Structure():
         0xff01: "Attentation.Response"
     }
     
-    def __init__(self, length=None, parent=None):
+    def __init__(self, length=None, parent=None, structure_type="Unknown"):
         self.parent = parent
         self.length = length
         self.children = []
+        self.structure_type = structure_type
     
     def __repr__(self):
         if self.parent is None:
@@ -121,7 +229,7 @@ class SML_Structure():
     
     def returnSelfOrParent(self):
         if self.length is not None and len(self.children) > self.length:
-            raise Exception("Error: structure contains more elements ({}) than allowed ({})".format(len(self.children), self.length))
+            raise SML_Parse_Error("Structure contains more elements ({}) than allowed ({})".format(len(self.children), self.length))
         if self.parent is not None and len(self.children) == self.length:
             return self.parent.returnSelfOrParent()
         return self
@@ -132,19 +240,19 @@ class SML_Structure():
         return newStructure
     
     def AddOctetString(self, length, data):
-        self.children.append(SML_Octet_String(length, data, self))
+        self.children.append(SML_Octet_String(length, data))
         return self.returnSelfOrParent()
     
     def AddSignedInteger(self, length, data):
-        self.children.append(SML_Signed_Integer(length, data, self))
+        self.children.append(SML_Signed_Integer(length, data))
         return self.returnSelfOrParent()
     
     def AddUnsignedInteger(self, length, data):
-        self.children.append(SML_Unsigned_Integer(length, data, self))
+        self.children.append(SML_Unsigned_Integer(length, data))
         return self.returnSelfOrParent()
     
     def AddEndOfMessage(self):
-        self.children.append(SML_End_of_Message(self))
+        self.children.append(SML_End_of_Message())
         return self.returnSelfOrParent()
     
     def GetRoot(self):
@@ -184,7 +292,7 @@ class SML_Structure():
     def _RecursiveGetListResponse(self):
         for child in self.children:
             if isinstance(child, SML_Structure):
-                if child.GetStructureTypeString() == "GetList.Response":
+                if child.structure_type == "GetList.Response":
                     return self
                 element = child._RecursiveGetListResponse()
                 if element is not None:
@@ -196,192 +304,1015 @@ class SML_Structure():
         for child in self.children:
             if isinstance(child, SML_Octet_String):
                 if child.data == obis_code:
-                    return child.parent
+                    return self
             elif isinstance(child, SML_Structure):
                 element = child.RecursiveObisFind(obis_code)
                 if element is not None:
                     return element
     
     def GetStructureTypeString(self):
-        if self.parent is None:
-            return "File"
-        if self.children and isinstance(self.children[-1], SML_End_of_Message):
-            return "Message"
-        if len(self.children) == 2 and isinstance(self.children[0], SML_Unsigned_Integer) and isinstance(self.children[1], SML_Structure):
-            return "MessageBody"
-        if self.parent.GetStructureTypeString() == "MessageBody" and self.parent.children[0].data in self.BODY_TYPES:
-            return self.BODY_TYPES[self.parent.children[0].data]
+        return self.structure_type
 
-        return "Unknown"
 
+class SML_File(SML_Structure):
+    # root of a parsed SML file. messages_by_type maps body type strings
+    # (e.g. "GetList.Response") to the list of message bodies of that type
+    __slots__ = ("messages_by_type",)
 
-def log_with_indent(*msg):
-    logging.debug("%s%s", len(LISTS) *  " ", *msg)
+    def __init__(self):
+        super().__init__(None, None, "File")
+        self.messages_by_type = {}
+
+    def AddMessageBody(self, message, message_body, body):
+        # called by the parsers as soon as the body of a message starts,
+        # 'body' is None if the body has been skipped (lazy mode)
+        message.structure_type = "Message"
+        message_body.structure_type = "MessageBody"
+        if body is not None:
+            body.structure_type = self.BODY_TYPES.get(message_body.children[0].data, "Unknown")
+            self.messages_by_type.setdefault(body.structure_type, []).append(body)
+
+    def GetListResponse(self):
+        bodies = self.messages_by_type.get("GetList.Response")
+        if bodies:
+            return bodies[0]
+        return None
+
+
+def crc16_update(crc, data):
+    # feed 'data' into a running checksum that has been started with CRC_INIT
+    return binascii.crc_hqx(bytes(data).translate(BIT_REVERSED), crc)
+
+
+def crc16_final(crc):
+    return ((BIT_REVERSED[crc & 0xFF] << 8) | BIT_REVERSED[crc >> 8]) ^ 0xFFFF
+
+
+def crc16(data):
+    return crc16_final(crc16_update(CRC_INIT, data))
+
+
+def crc16_matches(crc, checksum):
+    # the checksum is transmitted least significant byte first
+    return crc16_final(crc) == int.from_bytes(checksum, byteorder="little")
 
 
 def get_field_length(msg, pos):
+    # returns the length of the element starting at 'pos' and the position of its
+    # last TL byte. TL bytes with the extended bit set are followed by another TL
+    # byte holding the next four bits of the length. the length of a list is its
+    # number of elements. for all other types it covers the element including its
+    # TL bytes, but only one TL byte is counted (so the data ends at pos + length)
+    field_type, length = TL_TABLE[msg[pos]]
+    if length is not None:
+        return length, pos
+    start = pos
     length = msg[pos] & MASK_LENGTH
-    additional_bytes_read = 0
-    # detect extended TL byte
-    # that means we need to add the length part of the following byte
-    if msg[pos] & MASK_EXTENDED_TYPE == 0x80:
+    while msg[pos] & MASK_EXTENDED_TYPE:
         pos += 1
-        additional_bytes_read += 1
-        # shift the rightmost bits four to the left
-        length = (length << 4) & 0xFF
-        # 'or' the length-part of the next byte to the bit-shiftet length
-        length = length | (msg[pos] & MASK_LENGTH)
-    return length - additional_bytes_read, pos
-
-
-def parse_sml_bytestream(msg, footer):
-    global LISTS
-    shared_sml_data.SML_RAW_DATA = SML_Structure()
-    fill_byte_counter = int(footer[1])
-    logging.debug("Number of Fill Bytes: %d", fill_byte_counter)
-    # strip fill-bytes off the end
-    if fill_byte_counter > 0:
-        msg = msg[:fill_byte_counter * -1]
-    checksum = footer[2:]
-    pos = 0
-    try:
+        length = (length << 4) | (msg[pos] & MASK_LENGTH)
+    if field_type == TYPE_LIST:
+        return length, pos
+    return length - (pos - start), pos
+
+
+def skip_element(msg, pos):
+    # returns the position right after the element starting at 'pos'
+    # without creating any objects for it or its children
+    remaining = 1
+    while remaining:
+        remaining -= 1
+        field_type, length = TL_TABLE[msg[pos]]
+        if field_type == TYPE_END_OF_MESSAGE:
+            pos += 1
+            continue
+        if length is None:
+            length, pos = get_field_length(msg, pos)
+        if field_type == TYPE_LIST:
+            remaining += length
+            pos += 1
+        else:
+            pos += length
+    if pos > len(msg):
+        raise IndexError("skipped beyond end of message")
+    return pos
+
+
+class SML_Parser():
+    # parses complete SML files (see FrameScanner). all parsing state lives in the
+    # instance, so any number of parsers can be used in parallel threads. a single
+    # parser can parse any number of files, one at a time.
+    # the structure is built privately and only published once it is complete.
+    # in lazy mode values are only decoded once they are read and message bodies
+    # other than LAZY_BODY_TYPES are skipped altogether
+    def __init__(self, lazy=False, device=None):
+        self.lazy = lazy
+        self.device = device or ""
+        self.debug = False
+        self.stack = []
+
+    def log(self, *msg):
+        # callers check self.debug first, so no log strings are built needlessly
+        logging.debug("%s%s", (len(self.stack) - 1) * " ", *msg)
+
+    def add(self, element):
+        # add a leaf element and close all structures that are complete now
+        stack = self.stack
+        stack[-1].children.append(element)
+        while len(stack) > 1 and len(stack[-1].children) == stack[-1].length:
+            stack.pop()
+
+    def is_skippable_body(self):
+        # true right after the tag of a top level message body that is not of interest
+        stack = self.stack
+        if len(stack) != 3:
+            return False
+        message_body = stack[2]
+        return (message_body.length == 2 and len(message_body.children) == 1
+                and message_body.children[0].data not in LAZY_BODY_TYPES)
+
+    # element handlers (see TL_HANDLERS): called with the position of the last TL
+    # byte of an element and its length, return the position of the next element
+
+    def parse_end_of_message(self, msg, pos, length):
+        if self.debug:
+            self.log("End of SML Message")
+        self.add(SML_End_of_Message())
+        return pos + 1
+
+    def parse_list(self, msg, pos, length):
+        if self.debug:
+            self.log("List Element {}".format(length))
+        stack = self.stack
+        stack.append(stack[-1].AddStructure(length))
+        if len(stack) == 4 and len(stack[2].children) == 2:
+            stack[0].AddMessageBody(stack[1], stack[2], stack[3])
+        # empty lists are complete right away
+        while len(stack) > 1 and len(stack[-1].children) == stack[-1].length:
+            stack.pop()
+        return pos + 1
+
+    def parse_octet_string(self, msg, pos, length):
+        if self.lazy:
+            if self.debug:
+                self.log("Octet String {}".format(length - 1))
+            self.add(SML_Lazy_Octet_String(length, msg, pos + 1))
+        else:
+            oct_string = bytes(msg[pos + 1:pos + length])
+            if self.debug:
+                self.log("Octet String {} {} {}".format(length - 1, utils.hexlify(oct_string), obis.BytesToString(oct_string)))
+            self.add(SML_Octet_String(length, oct_string))
+        return pos + length
+
+    def parse_signed_int(self, msg, pos, length):
+        if self.lazy:
+            if self.debug:
+                self.log("Signed Int {}".format(length - 1))
+            self.add(SML_Lazy_Signed_Integer(length, msg, pos + 1))
+        else:
+            int_buf = msg[pos + 1:pos + length]
+            signed_int = int.from_bytes(int_buf, byteorder="big", signed=True)
+            if self.debug:
+                self.log("Signed Int {} {} {}".format(length - 1, utils.hexlify(int_buf), signed_int))
+            self.add(SML_Signed_Integer(length, signed_int))
+        return pos + length
+
+    def parse_unsigned_int(self, msg, pos, length):
+        if self.lazy:
+            if self.debug:
+                self.log("Unsigned Int {}".format(length - 1))
+            self.add(SML_Lazy_Unsigned_Integer(length, msg, pos + 1))
+        else:
+            uint_buf = msg[pos + 1:pos + length]
+            unsigned_int = int.from_bytes(uint_buf, byteorder="big", signed=False)
+            if self.debug:
+                self.log("Unsigned Int {} {} {}".format(length - 1, utils.hexlify(uint_buf), unsigned_int))
+            self.add(SML_Unsigned_Integer(length, unsigned_int))
+        return pos + length
+
+    def parse_bool(self, msg, pos, length):
+        value = msg[pos + 1] != 0x00
+        if self.debug:
+            self.log("Bool {} {} {}".format(length, msg[pos + 1], value))
+        self.add(SML_Boolean(length, value))
+        return pos + length
+
+    def parse_unknown(self, msg, pos, length):
+        raise SML_Parse_Error("Unknown Field Type found: {} at position {}".format(msg[pos], pos))
+
+    def parse(self, msg, footer):
+        start = time.perf_counter()
+        lazy = self.lazy
+        debug = self.debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if lazy:
+            # elements keep referencing the message, detach it from the scanner buffer
+            msg = bytes(msg)
+        root = SML_File()
+        stack = self.stack = [root]
+        fill_byte_counter = int(footer[1])
+        if debug:
+            logging.debug("Number of Fill Bytes: %d", fill_byte_counter)
+        # TL bytes and values are read from a view, stripping the fill bytes off
+        # the end does not copy the message
+        view = memoryview(msg)
+        size = len(view) - fill_byte_counter
+        msg = view[:size]
+        handlers = TL_HANDLERS
+        pos = 0
+        try:
+            while pos < size:
+                tl = msg[pos]
+                # skip message bodies nobody is interested in
+                if lazy and tl and len(stack) == 3 and self.is_skippable_body():
+                    end = skip_element(msg, pos)
+                    if debug:
+                        self.log("Skipped Element {}".format(end - pos))
+                    root.AddMessageBody(stack[1], stack[2], None)
+                    self.add(SML_Skipped_Element(pos, end))
+                    pos = end
+                    continue
+                handler, length = handlers[tl]
+                if length is None:
+                    length, pos = get_field_length(msg, pos)
+                pos = handler(self, msg, pos, length)
+            if pos > size:
+                raise IndexError("parsed beyond end of message")
+        except IndexError as e:
+            print("Tried to parse beyond end of message (position {}, message length {})".format(pos, size))
+            instrumentation.FRAME_ERRORS.inc((self.device, "parse"))
+            return None
+        except SML_Parse_Error as e:
+            logging.warning("{}, discarding message".format(e))
+            if debug:
+                logging.debug("Discarded message: %s", utils.hexlify(msg))
+            instrumentation.FRAME_ERRORS.inc((self.device, "parse"))
+            return None
+        finally:
+            self.stack = []
+            if not lazy:
+                # the scanner buffer can only be resized once all views are released
+                msg.release()
+                view.release()
+            instrumentation.DURATIONS.observe(time.perf_counter() - start, ("parse",))
+        if debug:
+            root.RecursiveLog()
+        return root
+
+
+# element handler and length of every TL byte (see TL_TABLE)
+TL_HANDLERS = tuple(({
+    TYPE_END_OF_MESSAGE: SML_Parser.parse_end_of_message,
+    TYPE_LIST: SML_Parser.parse_list,
+    TYPE_OCTET_STRING: SML_Parser.parse_octet_string,
+    TYPE_SIGNED_INT: SML_Parser.parse_signed_int,
+    TYPE_UNSIGNED_INT: SML_Parser.parse_unsigned_int,
+    TYPE_BOOL: SML_Parser.parse_bool,
+}.get(field_type, SML_Parser.parse_unknown), length) for field_type, length in TL_TABLE)
+
+
+def parse_sml_bytestream(msg, footer, lazy=False):
+    return SML_Parser(lazy).parse(msg, footer)
+
+
+class FrameScanner():
+    # incrementally splits a raw serial byte stream into SML transport frames.
+    # incoming chunks are appended to a reusable buffer and only bytes that
+    # have not been looked at before are scanned for escape sequences.
+    # frames with a wrong transport checksum are dropped unless verify_crc is False.
+    # 'device' is only used to label the instrumentation counters
+    def __init__(self, verify_crc=True, device=None):
+        self.verify_crc = verify_crc
+        self.device = device or ""
+        self.crc_errors = 0
+        # time spent scanning since the last complete frame
+        self.scan_time = 0.0
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.frame_start = -1
+        self.escaped = []
+
+    def feed(self, data):
+        # yields (message, footer) for every frame completed by 'data'. the message
+        # is a memoryview into the scanner buffer and is only valid until the
+        # consumer asks for the next frame
+        self.buffer += data
         while True:
-            # reached end of the message? bye
-            if pos >= len(msg):
+            # only the scanning is timed, not what the consumer does with a frame
+            start = time.perf_counter()
+            frame = self._next_frame()
+            self.scan_time += time.perf_counter() - start
+            if frame is None:
                 break
-            # track nested structures (only relevant for debug output)
-            if LISTS:
-                if LISTS[-1] <= 0:
-                    LISTS.pop()
-                LISTS[-1] -= 1
-            
-            # detect "End of SML Message" byte
-            if msg[pos] == 0x00:
-                log_with_indent("End of SML Message")
-                LISTS = []
-                pos += 1
-                shared_sml_data.SML_RAW_DATA = shared_sml_data.SML_RAW_DATA.AddEndOfMessage()
-            # detect list / sequence TL byte
-            elif msg[pos] & MASK_TYPE == TYPE_LIST:
-                length, pos = get_field_length(msg, pos)
-                log_with_indent("List Element {}".format(length))
-                LISTS.append(length)
-                shared_sml_data.SML_RAW_DATA = shared_sml_data.SML_RAW_DATA.AddStructure(length)
-                pos += 1
-            # detect octet string TL byte
-            elif msg[pos] & MASK_TYPE == TYPE_OCTET_STRING:
-                length, pos = get_field_length(msg, pos)
-                oct_string = msg[pos + 1:pos + length]
-                log_with_indent("Octet String {} {} {}".format(length - 1, utils.hexlify(oct_string), obis.BytesToString(oct_string)))
-                shared_sml_data.SML_RAW_DATA = shared_sml_data.SML_RAW_DATA.AddOctetString(length, oct_string)
-                pos += length
-            # detect signed int TL byte
-            elif msg[pos] & MASK_TYPE == TYPE_SIGNED_INT:
-                length, pos = get_field_length(msg, pos)
-                int_buf = msg[pos + 1:pos + length]
-                signed_int = int.from_bytes(int_buf, byteorder="big", signed=True)
-                log_with_indent("Signed Int {} {} {}".format(length - 1, utils.hexlify(int_buf), signed_int))
-                shared_sml_data.SML_RAW_DATA = shared_sml_data.SML_RAW_DATA.AddSignedInteger(length, signed_int)
-                pos += length
-            # detect unsigned int TL byte
-            elif msg[pos] & MASK_TYPE == TYPE_UNSIGNED_INT:
-                length, pos = get_field_length(msg, pos)
-                uint_buf = msg[pos + 1:pos + length]
-                unsigned_int = int.from_bytes(uint_buf, byteorder="big", signed=False)
-                log_with_indent("Unsigned Int {} {} {}".format(length - 1, utils.hexlify(uint_buf), unsigned_int))
-                shared_sml_data.SML_RAW_DATA = shared_sml_data.SML_RAW_DATA.AddUnsignedInteger(length, unsigned_int)
-                pos += length
-            # detect boolean TL byte
-            elif msg[pos] & MASK_TYPE == TYPE_BOOL:
-                length, pos = get_field_length(msg, pos)
-                pos += 1
-                if msg[pos] == 0x00:
-                    bool_data = False
-                else:
-                    bool_data = True
-                log_with_indent("Bool {} {} {}".format(length, msg[pos], bool_data))
-                pos += 1
+            instrumentation.DURATIONS.observe(self.scan_time, ("scan",))
+            self.scan_time = 0.0
+            msg, footer = frame
+            try:
+                yield msg, footer
+            finally:
+                msg.release()
+        self._compact()
+
+    def _next_frame(self):
+        # returns the next complete frame or None if more data is needed. the search
+        # goes on right after a discarded frame (looping, a chunk might hold
+        # thousands of corrupted frames)
+        buffer = self.buffer
+        while True:
+            if self.frame_start < 0:
+                start = buffer.find(START_SEQ, self.scan_pos)
+                if start < 0:
+                    # keep a possibly incomplete start sequence at the end of the buffer
+                    self.scan_pos = max(0, len(buffer) - len(START_SEQ) + 1)
+                    return None
+                logging.info("Detected SML Start Sequence")
+                if start > 0 and logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("Found extra data ahead of Start Sequence: %s", utils.hexlify(buffer[:start]))
+                self.frame_start = start + len(START_SEQ)
+                self.scan_pos = self.frame_start
+                self.escaped = []
+            frame = self._scan_frame()
+            if frame is not False:
+                return frame
+
+    def _scan_frame(self):
+        # looks for the end of the current frame: returns the frame, None if more
+        # data is needed or False if the frame was discarded
+        buffer = self.buffer
+        while True:
+            pos = buffer.find(ESCAPE_SEQ, self.scan_pos)
+            # escape sequences are always aligned to 4 byte blocks within a frame.
+            # an unaligned start sequence means the current frame got cut off
+            while pos >= 0 and (pos - self.frame_start) % 4:
+                if buffer[pos:pos + 8] == START_SEQ:
+                    logging.warning("Detected SML Start Sequence before the end of the previous message, discarding it")
+                    instrumentation.FRAME_ERRORS.inc((self.device, "incomplete"))
+                    self.frame_start = -1
+                    self.scan_pos = pos
+                    return False
+                if len(buffer) < pos + 8 and START_SEQ.startswith(buffer[pos:]):
+                    self.scan_pos = pos
+                    return None
+                pos = buffer.find(ESCAPE_SEQ, pos + 1)
+            if pos < 0:
+                self.scan_pos = max(self.frame_start, len(buffer) - len(ESCAPE_SEQ) + 1)
+                return None
+            # wait for the block following the escape sequence
+            if len(buffer) < pos + 8:
+                self.scan_pos = pos
+                return None
+            if buffer[pos + 4] == 0x1a:
+                if self.verify_crc and not self._checksum_matches(pos):
+                    self.frame_start = -1
+                    self.scan_pos = pos + 8
+                    return False
+                return self._complete_frame(pos)
+            if buffer[pos + 4:pos + 8] == ESCAPE_SEQ:
+                # escaped payload data, the second sequence is part of the message
+                self.escaped.append(pos)
+                self.scan_pos = pos + 8
+            elif buffer[pos:pos + 8] == START_SEQ:
+                logging.warning("Detected SML Start Sequence before the end of the previous message, discarding it")
+                instrumentation.FRAME_ERRORS.inc((self.device, "incomplete"))
+                self.frame_start = -1
+                self.scan_pos = pos
+                return False
             else:
-                raise Exception("Unknown Field Type found: {} at position {}, remaining msg: '{}'".format(msg[pos], pos, utils.hexlify(msg[pos:])))
-    except IndexError as e:
-        print("Tried to parse beyond end of message (position {}, message length {})".format(pos, len(msg)))
-    finally:
-        LISTS = []
-    if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
-        shared_sml_data.SML_RAW_DATA.GetRoot().RecursiveLog()
-
-def read_serial_data(device, baudrate):
+                logging.warning("Unknown escape sequence at position %d, discarding message", pos - self.frame_start)
+                instrumentation.FRAME_ERRORS.inc((self.device, "escape"))
+                self.frame_start = -1
+                self.scan_pos = pos + 4
+                return False
+
+    def _checksum_matches(self, end):
+        # the checksum covers the raw frame from the start sequence up to the fill byte counter
+        with memoryview(self.buffer) as view:
+            with view[self.frame_start - len(START_SEQ):end + 6] as frame:
+                crc = crc16_update(CRC_INIT, frame)
+        if crc16_matches(crc, self.buffer[end + 6:end + 8]):
+            return True
+        self.crc_errors += 1
+        logging.warning("SML message checksum mismatch, dropping message ({} checksum errors so far)".format(self.crc_errors))
+        instrumentation.FRAME_ERRORS.inc((self.device, "checksum"))
+        return False
+
+    def _complete_frame(self, end):
+        buffer = self.buffer
+        footer = bytes(buffer[end + 4:end + 8])
+        if self.escaped:
+            # drop the duplicate escape sequences (this requires a copy)
+            msg = bytearray()
+            pos = self.frame_start
+            for escape in self.escaped:
+                msg += buffer[pos:escape + 4]
+                pos = escape + 8
+            msg += buffer[pos:end]
+            msg = memoryview(bytes(msg))
+        else:
+            msg = memoryview(buffer)[self.frame_start:end]
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Detected SML Message Body: %s", utils.hexlify(msg))
+            logging.debug("Detected SML Message Footer: %s", utils.hexlify(footer))
+        self.frame_start = -1
+        self.scan_pos = end + 8
+        instrumentation.FRAMES.inc((self.device,))
+        return msg, footer
+
+    def _compact(self):
+        # drop everything that has been scanned and is not part of a pending frame
+        consumed = self.scan_pos if self.frame_start < 0 else self.frame_start - len(START_SEQ)
+        if consumed <= 0:
+            return
+        del self.buffer[:consumed]
+        self.scan_pos -= consumed
+        if self.frame_start >= 0:
+            self.frame_start -= consumed
+            self.escaped = [escape - consumed for escape in self.escaped]
+
+
+def read_available(sel, device):
+    # read everything the driver has buffered in one go
+    start = time.perf_counter()
+    data = sel.read(sel.in_waiting or 1)
+    instrumentation.DURATIONS.observe(time.perf_counter() - start, ("read",))
+    instrumentation.SERIAL_READS.inc((device,))
+    instrumentation.SERIAL_BYTES.inc((device,), len(data))
+    return data
+
+
+def read_serial_data(device, baudrate, lazy=False, verify_crc=True, layout_cache=True):
     sel = serial.Serial(port=device, baudrate=baudrate, timeout=0, rtscts=False, dsrdtr=False)
-    buffer = b''
-    start_seq_complete = False
-    received_msg = False
+    scanner = FrameScanner(verify_crc, device)
+    if layout_cache:
+        parser = SML_Layout_Parser(lazy, device)
+    else:
+        parser = SML_Parser(lazy, device)
 
     while True:
         rlist, _, _ = select.select([sel], [], [], 1.0)
         if sel not in rlist:
-            time.sleep(0.01)
             continue
 
-        data = sel.read(1)
+        data = read_available(sel, device)
         if not data:
             continue
 
-        buffer += data
+        for sml_msg, sml_footer in scanner.feed(data):
+            parsed = parser.parse(sml_msg, sml_footer)
+            if parsed is None:
+                continue
+            if layout_cache:
+                root, server_id, obis_data = parsed
+                shared_sml_data.publish(root, server_id or device, {"obis_data": obis_data})
+            else:
+                shared_sml_data.publish(parsed, get_server_id(parsed) or device)
 
-        if buffer.find(START_SEQ) > -1 and not start_seq_complete:
-            logging.info("Detected SML Start Sequence")
-            start_seq_complete = True
-            received_msg = False
-            if len(buffer) > len(START_SEQ):
-                logging.debug("Found extra data ahead of Start Sequence: %s", utils.hexlify(buffer[:-len(START_SEQ)]))
-            buffer = b''
-            continue
 
-        if start_seq_complete and buffer.endswith(ESCAPE_SEQ):
-            sml_msg = buffer[0:-len(ESCAPE_SEQ)]
-            logging.debug("Detected SML Message Body: %s", utils.hexlify(sml_msg))
-            buffer = b''
-            start_seq_complete = False
-            received_msg = True
+class SML_Stream_Parser():
+    # push based parser for a raw serial byte stream. feed() accepts chunks of any
+    # size and returns the events for every element completed by that chunk:
+    # - EVENT_FRAME_START: payload None
+    # - EVENT_MESSAGE_START: body type string, as soon as the message body tag is known
+    # - EVENT_LIST_VALUE: SML_Structure of a GetList.Response value list entry
+    # - EVENT_END_OF_MESSAGE: SML_Structure of the message
+    # - EVENT_FRAME_END: (root SML_Structure, footer)
+    # frames with a wrong transport checksum are dropped unless verify_crc is False.
+    # the checksum is only known at the end of the frame: all events but
+    # EVENT_FRAME_END are unverified and may belong to a frame that is dropped later
+    # (checksum, escape or incomplete message), which is only noticeable by the next
+    # EVENT_FRAME_START arriving without an EVENT_FRAME_END in between. consumers
+    # that need verified data (everything in this tree) only act on EVENT_FRAME_END.
+    # the parser does not use any threads, locks or global state, so it can be
+    # driven from threads as well as from an event loop. 'device' is only used to
+    # label the instrumentation counters
+    def __init__(self, verify_crc=True, device=None):
+        self.verify_crc = verify_crc
+        self.device = device or ""
+        self.crc_errors = 0
+        self.frames = 0
+        # time spent in feed() since the last complete frame
+        self.feed_time = 0.0
+        self.crc = CRC_INIT
+        self.raw = bytearray()
+        self.body = bytearray()
+        self.pos = 0
+        self.stack = None
+
+    def feed(self, data):
+        start = time.perf_counter()
+        frames = self.frames
+        events = []
+        self.raw += data
+        while True:
+            if self.stack is None and not self._find_start(events):
+                break
+            if not self._read_body(events):
+                break
+        self.feed_time += time.perf_counter() - start
+        if self.frames != frames:
+            instrumentation.DURATIONS.observe(self.feed_time, ("stream",))
+            self.feed_time = 0.0
+        return events
+
+    def _find_start(self, events):
+        raw = self.raw
+        start = raw.find(START_SEQ)
+        if start < 0:
+            # keep a possibly incomplete start sequence
+            del raw[:max(0, len(raw) - len(START_SEQ) + 1)]
+            return False
+        logging.info("Detected SML Start Sequence")
+        del raw[:start + len(START_SEQ)]
+        self.crc = crc16_update(CRC_INIT, START_SEQ) if self.verify_crc else CRC_INIT
+        self.body = bytearray()
+        self.pos = 0
+        self.stack = [SML_File()]
+        events.append((EVENT_FRAME_START, None))
+        return True
+
+    def _read_body(self, events):
+        # moves unescaped body data from the raw buffer to the body buffer. the raw
+        # buffer always starts at a 4 byte block boundary of the current frame
+        raw = self.raw
+        while True:
+            escape = raw.find(ESCAPE_SEQ)
+            while escape >= 0 and escape % 4:
+                if raw[escape:escape + 8] == START_SEQ:
+                    # an unaligned start sequence, the current frame got cut off
+                    logging.warning("Detected SML Start Sequence before the end of the previous message, discarding it")
+                    instrumentation.FRAME_ERRORS.inc((self.device, "incomplete"))
+                    del raw[:escape]
+                    self.stack = None
+                    return True
+                escape = raw.find(ESCAPE_SEQ, escape + 1)
+            if escape < 0:
+                # complete blocks only, except for what might be the beginning of
+                # an unaligned start sequence
+                size = max(0, len(raw) - len(START_SEQ) + 1)
+                self._consume(size - size % 4)
+                self._decode(events)
+                return False
+            self._consume(escape)
+            if len(raw) < 8:
+                self._decode(events)
+                return False
+            if raw[4:8] == ESCAPE_SEQ:
+                # escaped payload data
+                if self.verify_crc:
+                    self.crc = crc16_update(self.crc, raw[:8])
+                self.body += ESCAPE_SEQ
+                del raw[:8]
+                continue
+            if raw[4] == 0x1a:
+                footer = bytes(raw[4:8])
+                crc = crc16_update(self.crc, raw[:6]) if self.verify_crc else None
+                del raw[:8]
+                if crc is not None and not crc16_matches(crc, footer[2:]):
+                    self.crc_errors += 1
+                    logging.warning("SML message checksum mismatch, dropping message ({} checksum errors so far)".format(self.crc_errors))
+                    instrumentation.FRAME_ERRORS.inc((self.device, "checksum"))
+                    self.stack = None
+                    return True
+                self._decode(events)
+                self._end_frame(footer, events)
+            elif raw[:8] == START_SEQ:
+                logging.warning("Detected SML Start Sequence before the end of the previous message, discarding it")
+                instrumentation.FRAME_ERRORS.inc((self.device, "incomplete"))
+                self.stack = None
+            else:
+                logging.warning("Unknown escape sequence, discarding message")
+                instrumentation.FRAME_ERRORS.inc((self.device, "escape"))
+                del raw[:4]
+                self.stack = None
+            return True
+
+    def _consume(self, size):
+        # move 'size' bytes of payload data from the raw to the body buffer
+        raw = self.raw
+        if self.verify_crc:
+            self.crc = crc16_update(self.crc, raw[:size])
+        self.body += raw[:size]
+        del raw[:size]
+
+    def _end_frame(self, footer, events):
+        stack = self.stack
+        self.stack = None
+        if stack is None:
+            return
+        if len(stack) > 1 or self.pos < len(self.body):
+            logging.warning("Incomplete SML message (position {}, message length {}), discarding it".format(self.pos, len(self.body)))
+            instrumentation.FRAME_ERRORS.inc((self.device, "incomplete"))
+            return
+        self.frames += 1
+        instrumentation.FRAMES.inc((self.device,))
+        events.append((EVENT_FRAME_END, (stack[0], footer)))
+
+    def _decode(self, events):
+        # decode all elements that are completely available in the body buffer
+        stack = self.stack
+        if stack is None:
+            return
+        body = self.body
+        pos = self.pos
+        size = len(body)
+        while pos < size:
+            tl = body[pos]
+            field_type, length = TL_TABLE[tl]
+            if field_type == TYPE_END_OF_MESSAGE:
+                pos += 1
+                # outside of a message these are fill bytes
+                if len(stack) > 1:
+                    self._add(SML_End_of_Message(), events)
+                continue
+            end = pos
+            if length is None:
+                # the TL bytes might not be complete yet, see get_field_length
+                length = tl & MASK_LENGTH
+                while body[end] & MASK_EXTENDED_TYPE:
+                    end += 1
+                    if end >= size:
+                        self.pos = pos
+                        return
+                    length = (length << 4) | (body[end] & MASK_LENGTH)
+            if field_type == TYPE_LIST:
+                stack.append(stack[-1].AddStructure(length))
+                if len(stack) == 4 and len(stack[2].children) == 2:
+                    stack[0].AddMessageBody(stack[1], stack[2], stack[3])
+                pos = end + 1
+                self._complete(events)
+                continue
+            if pos + length > size:
+                break
+            data = body[end + 1:pos + length]
+            # element lengths include one TL byte, just like parse_sml_bytestream
+            element_length = len(data) + 1
+            if field_type == TYPE_OCTET_STRING:
+                self._add(SML_Octet_String(element_length, bytes(data)), events)
+            elif field_type == TYPE_SIGNED_INT:
+                self._add(SML_Signed_Integer(element_length, int.from_bytes(data, byteorder="big", signed=True)), events)
+            elif field_type == TYPE_UNSIGNED_INT:
+                self._add(SML_Unsigned_Integer(element_length, int.from_bytes(data, byteorder="big", signed=False)), events)
+            elif field_type == TYPE_BOOL:
+                self._add(SML_Boolean(element_length, any(data)), events)
+            else:
+                logging.warning("Unknown Field Type found: {} at position {}, discarding message".format(tl, pos))
+                instrumentation.FRAME_ERRORS.inc((self.device, "parse"))
+                self.stack = None
+                return
+            pos += length
+        self.pos = pos
+
+    def _add(self, element, events):
+        stack = self.stack
+        stack[-1].children.append(element)
+        # message body tag, the type of the message is known from now on
+        if len(stack) == 3 and len(stack[2].children) == 1 and isinstance(element, SML_Unsigned_Integer):
+            events.append((EVENT_MESSAGE_START, SML_Structure.BODY_TYPES.get(element.data, "Unknown")))
+        self._complete(events)
+
+    def _complete(self, events):
+        stack = self.stack
+        while len(stack) > 1 and len(stack[-1].children) == stack[-1].length:
+            structure = stack.pop()
+            depth = len(stack)
+            if depth == 1:
+                events.append((EVENT_END_OF_MESSAGE, structure))
+            elif depth == 5 and len(stack[3].children) == 5 and stack[2].children[0].data == 0x0701:
+                events.append((EVENT_LIST_VALUE, structure))
+
+
+def stream_serial_data(device, baudrate, verify_crc=True):
+    # like read_serial_data, but elements are parsed as soon as they arrive
+    sel = serial.Serial(port=device, baudrate=baudrate, timeout=0, rtscts=False, dsrdtr=False)
+    parser = SML_Stream_Parser(verify_crc, device)
+
+    while True:
+        rlist, _, _ = select.select([sel], [], [], 1.0)
+        if sel not in rlist:
             continue
 
-        if received_msg and len(buffer) >= 4 and buffer.find(b"\x1a") == 0:
-            sml_footer = buffer
-            logging.debug("Detected SML Message Footer: %s", utils.hexlify(sml_footer))
-            lock = threading.Lock()
-            with lock:
-                parse_sml_bytestream(sml_msg, sml_footer)
-            buffer = b""
-            received_msg = False
+        data = read_available(sel, device)
+        if not data:
             continue
 
+        for event, payload in parser.feed(data):
+            if event == EVENT_FRAME_END:
+                root, _ = payload
+                shared_sml_data.publish(root, get_server_id(root) or device)
+
+
+def get_server_id(root):
+    # server id of the meter that sent the SML file (e.g. "0a-01-45-4d-48-00-00-12-34-56")
+    # taken from the GetList.Response or Open.Response. None if there is none
+    candidates = []
+    list_response = root.GetListResponse()
+    if list_response is not None:
+        candidates.append(list_response.children[1])
+    for open_response in root.messages_by_type.get("Open.Response", []):
+        candidates.append(open_response.children[3])
+    for candidate in candidates:
+        if isinstance(candidate, SML_Octet_String) and candidate.data:
+            return utils.hexlify(candidate.data).replace(" ", "-")
+    return None
+
+
+def decode_list_entry(entry):
+    # returns (code, value, unit) of a GetList.Response value list entry
+    # or None if the OBIS code is unknown
+    code = obis.INDEX.get(entry.children[0].data)
+    if code is None:
+        return None
+    item = obis.CODES[code]
+    value = None
+    unit = None
+    if item["type"] == obis.TYPE_STRING:
+        try:
+            value = entry.children[5].data.decode("utf-8")
+        except UnicodeDecodeError:
+            logging.error("Could not decode UTF-8 string for OBIS code '{}'".format(item["description"]))
+            value = ""
+    elif item["type"] in [obis.TYPE_GAUGE, obis.TYPE_COUNTER]:
+        # the scaler is optional, some meters (e.g. ISKRA MT631) omit it for power values
+        scaler = entry.children[4].data
+        value = entry.children[5].data
+        if isinstance(scaler, int):
+            value = value * 10 ** scaler
+        unit = obis.GetUnitFromCode(entry.children[3].data)
+    elif item["type"] == obis.TYPE_BINARY:
+        value = utils.hexlify(entry.children[5].data)
+    return code, value, unit
+
 
 def extract_obis_response_data(response):
     data = {}
     for code, item in obis.CODES.items():
-        obis_data_structure = response.children[4]
-        value = None
-        unit = None
-        for child in obis_data_structure.children:
-            if child.children[0].data != item["bytes"]:
-                continue
+        data[code] = {
+            "description": item["description"],
+            "internal_name": item["internal_name"],
+            "unit": None,
+            "value": None,
+            "type": item["type"],
+        }
+    # single pass over the value list, entries are matched via the OBIS index
+    for child in response.children[4].children:
+        decoded = decode_list_entry(child)
+        if decoded is None:
+            continue
+        code, value, unit = decoded
+        data[code]["value"] = value
+        data[code]["unit"] = unit
+    return data
+
+
+def _extract_snapshot_obis_data(snapshot):
+    list_response = snapshot.root.GetListResponse()
+    if list_response is None:
+        return None
+    start = time.perf_counter()
+    obis_data = extract_obis_response_data(list_response)
+    instrumentation.DURATIONS.observe(time.perf_counter() - start, ("extract",))
+    return obis_data
+
+
+def get_obis_data(snapshot):
+    # decoded OBIS data of a snapshot, extracted once and shared by all readers
+    # (do not modify the returned dictionary). returns None if the snapshot
+    # does not contain a GetList.Response
+    return snapshot.cached("obis_data", _extract_snapshot_obis_data)
+
+
+# frames of the same meter usually share their byte layout, only values (and their
+# signatures) change. SML_Layout_Parser remembers the layout of parsed frames and
+# reads the OBIS values of later frames with the same layout straight from the
+# message. TL bytes and OBIS codes of a frame are compared to the layout first,
+# anything that does not match is parsed completely
+
+# value list entries: position of the OBIS code, status, value time, unit, scaler and value
+ENTRY_CODE = 0
+ENTRY_UNIT = 3
+ENTRY_SCALER = 4
+ENTRY_VALUE = 5
+
+
+class SML_Deferred_File():
+    # stands in for the SML_File of a frame that has been read via its layout. the
+    # frame is only parsed once somebody needs its structure (e.g. --dump-file)
+    __slots__ = ("_msg", "_footer", "_lazy", "_root")
+
+    def __init__(self, msg, footer, lazy=False):
+        self._msg = msg
+        self._footer = footer
+        self._lazy = lazy
+        self._root = None
+
+    def __getattr__(self, name):
+        root = self._root
+        if root is None:
+            root = self._root = SML_Parser(self._lazy).parse(self._msg, self._footer)
+        return getattr(root, name)
+
+
+def read_leaf(msg, leaf):
+    # value of a (field type, start, end) leaf of a layout, like the parser decodes it
+    field_type, start, end = leaf
+    if field_type == TYPE_OCTET_STRING:
+        return bytes(msg[start:end])
+    return int.from_bytes(msg[start:end], byteorder="big", signed=field_type == TYPE_SIGNED_INT)
+
+
+def walk_layout(msg, size):
+    # walks the TL bytes of an SML file exactly like SML_Parser does, but only keeps
+    # [length, children] for lists, (field type, start, end) for values and None for
+    # end of message markers. returns (root, TL byte positions, GetList.Response,
+    # Open.Responses) or None for anything the parser would not accept as is
+    root = [None, []]
+    stack = [root]
+    positions = []
+    list_response = None
+    open_responses = []
+    pos = 0
+    while pos < size:
+        positions.append(pos)
+        field_type, length = TL_TABLE[msg[pos]]
+        if length is None:
+            start = pos
+            length, pos = get_field_length(msg, pos)
+            positions.extend(range(start + 1, pos + 1))
+        if field_type == TYPE_END_OF_MESSAGE:
+            stack[-1][1].append(None)
+            pos += 1
+        elif field_type == TYPE_LIST:
+            structure = [length, []]
+            stack[-1][1].append(structure)
+            stack.append(structure)
+            if len(stack) == 4 and len(stack[2][1]) == 2:
+                tag = stack[2][1][0]
+                tag = read_leaf(msg, tag) if tag is not None and tag[0] in (TYPE_SIGNED_INT, TYPE_UNSIGNED_INT) else None
+                if tag == 0x0701 and list_response is None:
+                    list_response = structure
+                elif tag == 0x0101:
+                    open_responses.append(structure)
+            pos += 1
+        elif field_type in (TYPE_OCTET_STRING, TYPE_SIGNED_INT, TYPE_UNSIGNED_INT, TYPE_BOOL):
+            stack[-1][1].append((field_type, pos + 1, pos + length))
+            pos += length
+        else:
+            return None
+        while len(stack) > 1 and len(stack[-1][1]) == stack[-1][0]:
+            stack.pop()
+    if pos != size:
+        return None
+    return root, positions, list_response, open_responses
+
+
+class SML_Layout():
+    # byte layout of an SML file: the positions and values of all TL bytes and OBIS
+    # codes and where to find the values of every known OBIS code
+    __slots__ = ("size", "get_skeleton", "skeleton", "server_ids", "entries")
+
+    def __init__(self, size, positions, server_ids, entries):
+        self.size = size
+        self.get_skeleton = operator.itemgetter(*positions)
+        self.skeleton = None
+        # candidates for the server id (see get_server_id), octet string leaves
+        self.server_ids = server_ids
+        # (code, value leaf, unit leaf, scaler leaf) of known OBIS codes in list order
+        self.entries = entries
+
+    def read(self, msg):
+        # returns (server id, OBIS data) of a frame with this layout, None otherwise
+        if len(msg) != self.size or self.get_skeleton(msg) != self.skeleton:
+            return None
+        server_id = None
+        for _, start, end in self.server_ids:
+            if end > start:
+                server_id = utils.hexlify(msg[start:end]).replace(" ", "-")
+                break
+        data = {}
+        for code, item in obis.CODES.items():
+            data[code] = {
+                "description": item["description"],
+                "internal_name": item["internal_name"],
+                "unit": None,
+                "value": None,
+                "type": item["type"],
+            }
+        for code, value_leaf, unit_leaf, scaler_leaf in self.entries:
+            item = obis.CODES[code]
+            unit = None
             if item["type"] == obis.TYPE_STRING:
                 try:
-                    value = child.children[5].data.decode("utf-8")
+                    value = bytes(msg[value_leaf[1]:value_leaf[2]]).decode("utf-8")
                 except UnicodeDecodeError:
                     logging.error("Could not decode UTF-8 string for OBIS code '{}'".format(item["description"]))
                     value = ""
             elif item["type"] in [obis.TYPE_GAUGE, obis.TYPE_COUNTER]:
-                scaler = 10 ** child.children[4].data
-                value = child.children[5].data * scaler
-                unit = obis.GetUnitFromCode(child.children[3].data)
+                value = read_leaf(msg, value_leaf)
+                if scaler_leaf[0] != TYPE_OCTET_STRING:
+                    value = value * 10 ** read_leaf(msg, scaler_leaf)
+                unit = obis.GetUnitFromCode(read_leaf(msg, unit_leaf))
             elif item["type"] == obis.TYPE_BINARY:
-                value = utils.hexlify(child.children[5].data)
-        data[code] = {
-            "description": item["description"],
-            "internal_name": item["internal_name"],
-            "unit": unit,
-            "value": value,
-            "type": item["type"],
-        }
-    return data
+                value = utils.hexlify(msg[value_leaf[1]:value_leaf[2]])
+            else:
+                value = None
+            data[code]["value"] = value
+            data[code]["unit"] = unit
+        return server_id, data
+
+
+def get_layout(msg, footer):
+    # layout of an SML file with a GetList.Response or None if it has none or uses
+    # anything the layout cannot represent (such files are always parsed)
+    fill = int(footer[1])
+    size = len(msg) - fill
+    try:
+        walked = walk_layout(msg, size)
+    except IndexError:
+        return None
+    if walked is None:
+        return None
+    _, positions, list_response, open_responses = walked
+    if list_response is None or len(list_response[1]) < 5 or not isinstance(list_response[1][4], list):
+        return None
+    # the server id candidates of get_server_id, all of them need to be octet strings
+    candidates = [list_response[1][1]]
+    for open_response in open_responses:
+        if len(open_response[1]) < 4:
+            return None
+        candidates.append(open_response[1][3])
+    server_ids = [leaf for leaf in candidates if isinstance(leaf, tuple) and leaf[0] == TYPE_OCTET_STRING]
+    entries = []
+    for entry in list_response[1][4][1]:
+        if not isinstance(entry, list) or len(entry[1]) <= ENTRY_VALUE:
+            return None
+        # status and value time may be anything, the other fields have to be values
+        for index in (ENTRY_CODE, ENTRY_UNIT, ENTRY_SCALER, ENTRY_VALUE):
+            if not isinstance(entry[1][index], tuple) or entry[1][index][0] == TYPE_BOOL:
+                return None
+        code_leaf = entry[1][ENTRY_CODE]
+        # OBIS codes are part of the skeleton, the code of an entry never changes
+        positions.extend(range(code_leaf[1], code_leaf[2]))
+        code = obis.INDEX.get(read_leaf(msg, code_leaf))
+        if code is None:
+            continue
+        value_leaf, unit_leaf, scaler_leaf = entry[1][ENTRY_VALUE], entry[1][ENTRY_UNIT], entry[1][ENTRY_SCALER]
+        item_type = obis.CODES[code]["type"]
+        is_octet_string = value_leaf[0] == TYPE_OCTET_STRING
+        if item_type in [obis.TYPE_STRING, obis.TYPE_BINARY] and not is_octet_string:
+            return None
+        if item_type in [obis.TYPE_GAUGE, obis.TYPE_COUNTER] and is_octet_string:
+            return None
+        entries.append((code, value_leaf, unit_leaf, scaler_leaf))
+    if len(positions) < 2:
+        return None
+    layout = SML_Layout(len(msg), positions, server_ids, entries)
+    layout.skeleton = layout.get_skeleton(msg)
+    return layout
+
+
+class SML_Layout_Parser():
+    # decodes SML files via the layout of previous files, falls back to SML_Parser
+    # files with a new layout. the last 'cache_size' layouts
+    # are kept, so a few meters sharing a line do not evict each other
+    def __init__(self, lazy=False, device=None, cache_size=16):
+        self.parser = SML_Parser(lazy, device)
+        self.device = device or ""
+        self.cache_size = cache_size
+        # (message length, fill bytes) -> list of layouts
+        self.layouts = {}
+        self.layout_count = 0
+
+    def parse(self, msg, footer):
+        # returns (root, server id, OBIS data) or None if the file could not be parsed.
+        # OBIS data is None if the file has no GetList.Response
+        key = (len(msg), footer[1])
+        start = time.perf_counter()
+        for layout in self.layouts.get(key, ()):
+            result = layout.read(msg)
+            if result is not None:
+                instrumentation.DURATIONS.observe(time.perf_counter() - start, ("layout",))
+                instrumentation.LAYOUTS.inc((self.device, "hit"))
+                server_id, obis_data = result
+                return SML_Deferred_File(bytes(msg), footer, self.parser.lazy), server_id, obis_data
+        instrumentation.LAYOUTS.inc((self.device, "miss"))
+        root = self.parser.parse(msg, footer)
+        if root is None:
+            return None
+        server_id = get_server_id(root)
+        list_response = root.GetListResponse()
+        if list_response is None:
+            return root, server_id, None
+        obis_data = extract_obis_response_data(list_response)
+        layout = get_layout(msg, footer)
+        # only layouts that decode this very file like the parser did are kept
+        if layout is not None and layout.read(msg) == (server_id, obis_data):
+            self.add_layout(key, layout)
+        elif logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("SML message layout can not be cached, parsing every message")
+        return root, server_id, obis_data
+
+    def add_layout(self, key, layout):
+        if self.layout_count >= self.cache_size:
+            oldest = next(iter(self.layouts))
+            self.layout_count -= len(self.layouts.pop(oldest))
+        self.layouts.setdefault(key, []).insert(0, layout)
+        self.layout_count += 1
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import serial
+
+import debug
+import http_api
+import history
+import shared_sml_data
+import sml
+import sml_mqtt
+import snapshot_ring
+
+
+class SnapshotQueues():
+    # pushes published snapshots to all subscribed consumers. every consumer has
+    # its own queue that only holds the latest snapshot, slow consumers skip versions
+    def __init__(self):
+        self.queues = []
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=1)
+        self.queues.append(queue)
+        return queue
+
+    def publish(self, snapshot):
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(snapshot)
+
+
+def add_serial_reader(loop, device, baudrate, verify_crc, queues):
+    # registers the serial device with the event loop, received data is fed
+    # into an incremental parser right away
+    sel = serial.Serial(port=device, baudrate=baudrate, timeout=0, rtscts=False, dsrdtr=False)
+    parser = sml.SML_Stream_Parser(verify_crc, device)
+
+    def on_readable():
+        try:
+            data = sml.read_available(sel, device)
+        except OSError:
+            # e.g. the USB reading head was unplugged (serial.SerialException is an
+            # OSError). like a reader thread, stop reading this device instead of
+            # being called again for the same error
+            logging.exception("Could not read from {}, no longer reading SML data from it".format(device))
+            loop.remove_reader(sel.fileno())
+            sel.close()
+            return
+        for event, payload in parser.feed(data):
+            if event == sml.EVENT_FRAME_END:
+                root, _ = payload
+                queues.publish(shared_sml_data.publish(root, sml.get_server_id(root) or device))
+
+    loop.add_reader(sel.fileno(), on_readable)
+    logging.info("Reading SML data from {} ({} baud)".format(device, baudrate))
+    return sel
+
+
+async def dump_sml_data(queue, interval, file_path):
+    while True:
+        await queue.get()
+        debug.write_sml_dump(file_path, shared_sml_data.get_snapshots())
+        await asyncio.sleep(interval)
+
+
+async def print_obis_data(queue, interval):
+    while True:
+        await queue.get()
+        for meter_id, snapshot in shared_sml_data.get_snapshots().items():
+            debug.print_snapshot_obis_data(meter_id, snapshot)
+        await asyncio.sleep(interval)
+
+
+async def publish_mqtt(queue, client, interval):
+    # the sink only queues messages, publishing never blocks the event loop
+    while True:
+        await queue.get()
+        for meter_id, snapshot in shared_sml_data.get_snapshots().items():
+            sml_mqtt.publish_snapshot(client, meter_id, snapshot)
+        await asyncio.sleep(interval)
+
+
+async def publish_mqtt_on_change(queue, client, threshold, refresh_interval):
+    publisher = sml_mqtt.ChangePublisher(client, threshold, refresh_interval)
+    while True:
+        try:
+            await asyncio.wait_for(queue.get(), refresh_interval)
+        except asyncio.TimeoutError:
+            pass
+        publisher.publish(shared_sml_data.get_snapshots())
+
+
+async def record_history(queue, store):
+    while True:
+        try:
+            await asyncio.wait_for(queue.get(), store.flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            store.record(shared_sml_data.get_snapshots())
+        except Exception:
+            logging.exception("Could not record history")
+
+
+async def write_snapshot_ring(queue, writer):
+    while True:
+        try:
+            await asyncio.wait_for(queue.get(), snapshot_ring.METRICS_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        writer.write(shared_sml_data.get_snapshots())
+        writer.update_metrics()
+
+
+async def run(args, devices, ring_writer=None):
+    # runs readers and all publishers in a single thread. 'args' are the
+    # command line arguments of sml-reader.py, 'devices' a list of (device, baudrate).
+    # with a 'ring_writer' the API is served by worker processes (see snapshot_ring)
+    loop = asyncio.get_running_loop()
+    queues = SnapshotQueues()
+    serial_devices = [add_serial_reader(loop, device, baudrate, not args.skip_crc_check, queues) for device, baudrate in devices]
+
+    if ring_writer is not None:
+        tasks = [write_snapshot_ring(queues.subscribe(), ring_writer)]
+    else:
+        tasks = [http_api.serve_async_api(args.api_bind_ip, args.api_bind_port, queues.subscribe(), args.api_max_connections, args.api_keep_alive_timeout, args.api_backlog)]
+    if args.dump_file is not None:
+        logging.info("Dumping SML data to {} (at most every {} seconds)".format(args.dump_file, args.dump_file_interval))
+        tasks.append(dump_sml_data(queues.subscribe(), args.dump_file_interval, args.dump_file))
+    if args.dump_console:
+        logging.info("Dumping OBIS data to console (at most every {} seconds)".format(args.dump_console_interval))
+        tasks.append(print_obis_data(queues.subscribe(), args.dump_console_interval))
+    if args.mqtt_host is not None:
+        mqtt_client = sml_mqtt.connect(args.mqtt_host, args.mqtt_port, args.mqtt_qos, args.mqtt_queue_size, args.mqtt_spool_file, args.mqtt_json)
+    if args.mqtt_host is not None and args.mqtt_on_change:
+        logging.info("Publishing changed OBIS data to MQTT (all data every {} seconds)".format(args.mqtt_refresh_interval))
+        tasks.append(publish_mqtt_on_change(queues.subscribe(), mqtt_client, args.mqtt_threshold, args.mqtt_refresh_interval))
+    elif args.mqtt_host is not None:
+        logging.info("Publishing OBIS data to MQTT (at most every {} seconds)".format(args.mqtt_interval))
+        tasks.append(publish_mqtt(queues.subscribe(), mqtt_client, args.mqtt_interval))
+    history_store = None
+    if args.history_dir is not None:
+        logging.info("Recording history to {} (writing every {} seconds)".format(args.history_dir, args.history_flush_interval))
+        history_store = history.HistoryStore(args.history_dir, args.history_segment_duration, args.history_flush_interval)
+        http_api.HISTORY_STORE = history_store
+        tasks.append(record_history(queues.subscribe(), history_store))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if history_store is not None:
+            history_store.close()
+        for serial_device in serial_devices:
+            if serial_device.is_open:
+                loop.remove_reader(serial_device.fileno())
+                serial_device.close()
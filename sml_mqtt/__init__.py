@@ -1,53 +1,330 @@
 import paho.mqtt.client as mqtt
+import collections
+import json
 import logging
-import time
+import os
 import threading
+import time
 
+import instrumentation
 import sml
 import shared_sml_data
 import obis
 
-def connect(host, port):
-    def on_connect(client, userdata, flags, rc):
+# upper bounds (in seconds) of the histogram of how long messages were queued
+DELAY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+DELAYS = instrumentation.Histogram("sml_reader_mqtt_delay_seconds", "Time from queueing an MQTT message to handing it to the broker", DELAY_BUCKETS)
+
+class MqttSink():
+    # publishes queued messages from its own thread, so a slow or unreachable broker
+    # never blocks the readers. the queue is bounded: once it is full, the oldest
+    # messages are spilled to 'spool_path' (if set) or dropped. paho's network loop
+    # takes care of reconnecting (with backoff) and of QoS acknowledgements. QoS 1/2
+    # messages paho accepted are resent by paho itself after a reconnect, its own
+    # queue of them is bounded by 'queue_size' as well
+    def __init__(self, host, port, qos=0, queue_size=10000, spool_path=None, json_payload=False):
+        self.qos = qos
+        self.queue_size = queue_size
+        self.spool_path = spool_path
+        self.json_payload = json_payload
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.connected = False
+        self.spooled = 0
+        self.queued = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.sent = 0
+        if spool_path is not None:
+            self.recover_spool()
+        if spool_path is not None and os.path.exists(spool_path):
+            with open(spool_path) as spool:
+                self.spooled = sum(1 for line in spool)
+            logging.info("Found {} spooled MQTT messages in {}".format(self.spooled, spool_path))
+        logging.info("Connecting to {}:{}".format(host, port))
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            # paho-mqtt 2.x refuses to guess the signature of our callbacks
+            self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1, client_id="sml-reader")
+        else:
+            self.client = mqtt.Client("sml-reader")
+        self.client.max_queued_messages_set(queue_size)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+        self.client.connect_async(host, port, 60)
+        self.client.loop_start()
+        self.thread = threading.Thread(name="MqttSink", target=self.run, daemon=True)
+        self.thread.start()
+
+    def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
-            logging.info("Connected to MQTT broker")
+            logging.info("Connected to MQTT broker ({} messages waiting)".format(len(self.queue) + self.spooled))
+            with self.condition:
+                self.connected = True
+                self.condition.notify_all()
         else:
             logging.warning("Failed to connect to MQTT broker")
-    logging.info("Connecting to {}:{}".format(host, port))
-    client = mqtt.Client("sml-reader")
-    client.on_connect = on_connect
-    client.connect(host, port, 60)
-    return client
-
-def start_mqtt(host, port, interval):
-    client = connect(host, port)
+
+    def on_disconnect(self, client, userdata, rc):
+        with self.condition:
+            self.connected = False
+        if rc != 0:
+            logging.warning("Lost connection to MQTT broker, reconnecting")
+
+    def publish(self, topic, payload):
+        with self.condition:
+            if len(self.queue) >= self.queue_size:
+                self.spill()
+            self.queue.append((topic, payload, time.time()))
+            self.queued += 1
+            self.condition.notify()
+
+    def spill(self):
+        # makes room in the queue, must be called with the condition held. spilling
+        # works in batches so the spool file is not reopened for every message
+        count = 1 if self.spool_path is None else max(1, self.queue_size // 10)
+        messages = [self.queue.popleft() for _ in range(min(count, len(self.queue)))]
+        if self.spool_path is not None:
+            try:
+                with open(self.spool_path, "a") as spool:
+                    for message in messages:
+                        spool.write(json.dumps(message) + "\n")
+                self.spooled += len(messages)
+                self.spilled += len(messages)
+                return
+            except OSError as e:
+                logging.error("Could not spill MQTT messages to {}: {}".format(self.spool_path, e))
+        self.dropped += len(messages)
+        logging.debug("MQTT queue is full, dropped {} messages".format(len(messages)))
+
+    def send(self, topic, payload, queued_at=None):
+        # returns whether paho took the message. paho keeps QoS 1/2 messages that it
+        # could not send because the connection was lost meanwhile (they got a mid)
+        # and sends them once it is back, they must not be queued again
+        info = self.client.publish(topic, payload, self.qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and not (self.qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN and info.mid):
+            return False
+        self.sent += 1
+        # messages spooled by older versions do not know when they were queued
+        if queued_at is not None:
+            DELAYS.observe(time.time() - queued_at)
+        return True
+
+    def recover_spool(self):
+        # a crash while draining leaves the messages that were being sent in the
+        # .draining file, they go back in front of the spool. a crash while spilling
+        # might leave a truncated last line, new spills must not be appended to it
+        draining_path = self.spool_path + ".draining"
+        lines = []
+        for path in (draining_path, self.spool_path):
+            if os.path.exists(path):
+                with open(path) as spool:
+                    lines += spool.readlines()
+        if not os.path.exists(draining_path) and (not lines or lines[-1].endswith("\n")):
+            return
+        with open(self.spool_path, "w") as spool:
+            spool.writelines(line if line.endswith("\n") else line + "\n" for line in lines)
+        if os.path.exists(draining_path):
+            os.remove(draining_path)
+            logging.info("Recovered spooled MQTT messages from {}".format(draining_path))
+
+    def drain_spool(self):
+        # spooled messages are older than anything in the queue, they are sent first.
+        # whatever could not be sent is put back in front of messages spilled meanwhile
+        draining_path = self.spool_path + ".draining"
+        with self.condition:
+            os.replace(self.spool_path, draining_path)
+            self.spooled = 0
+        with open(draining_path) as spool:
+            lines = spool.readlines()
+        for position, line in enumerate(lines):
+            try:
+                message = json.loads(line)
+                if not isinstance(message, list) or len(message) not in (2, 3):
+                    raise ValueError("not a spooled message")
+            except ValueError:
+                # e.g. the last line of a spill that was interrupted by a crash
+                logging.warning("Dropping malformed spooled MQTT message: {!r}".format(line[:100]))
+                with self.condition:
+                    self.dropped += 1
+                continue
+            if not self.send(*message):
+                with self.condition:
+                    remaining = lines[position:]
+                    if os.path.exists(self.spool_path):
+                        with open(self.spool_path) as spool:
+                            remaining += spool.readlines()
+                    with open(self.spool_path, "w") as spool:
+                        spool.writelines(remaining)
+                    self.spooled = len(remaining)
+                break
+        os.remove(draining_path)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.connected and (self.queue or self.spooled))
+                # decide while holding the condition, a publish() may spill the queue right after
+                drain = self.spooled > 0
+                if not drain:
+                    messages = [self.queue.popleft() for _ in range(min(100, len(self.queue)))]
+            if drain:
+                self.drain_spool()
+                continue
+            for position, message in enumerate(messages):
+                if not self.send(*message):
+                    with self.condition:
+                        self.queue.extendleft(reversed(messages[position:]))
+                        # wait for on_connect/on_disconnect instead of spinning
+                        self.condition.wait(1)
+                    break
+
+    def get_counters(self):
+        with self.condition:
+            # age of the oldest message in the queue (spooled messages are even older)
+            lag = time.time() - self.queue[0][2] if self.queue else 0.0
+            return {
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "spilled": self.spilled,
+                "sent": self.sent,
+                "waiting": len(self.queue) + self.spooled,
+                "lag": lag,
+            }
+
+
+# the sink of the running sml-reader, reported on /metrics
+SINK = None
+
+
+def connect(host, port, qos=0, queue_size=10000, spool_path=None, json_payload=False):
+    global SINK
+    SINK = MqttSink(host, port, qos, queue_size, spool_path, json_payload)
+    return SINK
+
+
+def get_message_counters():
+    if SINK is None:
+        return {}
+    counters = SINK.get_counters()
+    return {(state,): counters[state] for state in ("queued", "sent", "spilled", "dropped")}
+
+
+def get_sink_gauge(name):
+    if SINK is None:
+        return {}
+    if name == "connected":
+        return {(): int(SINK.connected)}
+    return {(): SINK.get_counters()[name]}
+
+
+instrumentation.Callback("sml_reader_mqtt_messages_total", "counter", "Number of MQTT messages by what happened to them", get_message_counters, ("state",))
+instrumentation.Callback("sml_reader_mqtt_waiting_messages", "gauge", "Number of MQTT messages waiting to be published (queued and spooled)", lambda: get_sink_gauge("waiting"))
+instrumentation.Callback("sml_reader_mqtt_lag_seconds", "gauge", "Age of the oldest MQTT message waiting in the queue", lambda: get_sink_gauge("lag"))
+instrumentation.Callback("sml_reader_mqtt_connected", "gauge", "Whether the MQTT broker is connected", lambda: get_sink_gauge("connected"))
+
+
+# topic names of every meter, (manufacturer, serial, serverid) -> (base topic, {code: topic})
+TOPICS = {}
+
+
+def get_topics(obis_data):
+    manufacturer_data = obis_data[obis.CODE_MANUFACTURER]
+    manufacturer = manufacturer_data["value"] if manufacturer_data["value"] is not None else "unknown_manufacturer"
+    
+    serial_data = obis_data[obis.CODE_SERIAL]
+    serial = serial_data["value"] if serial_data["value"] is not None else "unknown_serial"
+    
+    serverid_data = obis_data[obis.CODE_ID]
+    serverid = serverid_data["value"].replace(" ","-") if serverid_data["value"] is not None else "unknown_serverid"
+    labels = (manufacturer, serial, serverid)
+    topics = TOPICS.get(labels)
+    if topics is None:
+        base_topic = "sml/{}/{}/{}".format(manufacturer, serial, serverid)
+        topics = {}
+        for code, item in obis.CODES.items():
+            if item["type"] in [obis.TYPE_GAUGE, obis.TYPE_COUNTER]:
+                topics[code] = "{}/{}".format(base_topic, item["internal_name"])
+        topics = (base_topic, topics)
+        TOPICS[labels] = topics
+    return topics
+
+
+def publish_snapshot(client, meter_id, snapshot, published=None, threshold=None):
+    # publishes the gauges and counters of a snapshot. values are recorded in 'published'
+    # (code -> value) if given. with a 'threshold', only values that changed by more
+    # than that since they were last published are sent. with json payloads, all values
+    # go into a single message on the meter's base topic
+    start = time.perf_counter()
+    obis_data = sml.get_obis_data(snapshot)
+    if obis_data is None:
+        logging.warning("Could not publish any OBIS data of meter {} - none found in the last SML message".format(meter_id))
+        return
+    if threshold is None:
+        logging.info("Publishing OBIS data of meter {} to MQTT".format(meter_id))
+    base_topic, topics = get_topics(obis_data)
+    values = {}
+    for code, topic in topics.items():
+        value = 0 if obis_data[code]["value"] is None else obis_data[code]["value"]
+        if published is not None:
+            if threshold is not None and code in published and abs(value - published[code]) <= threshold:
+                continue
+            published[code] = value
+        if client.json_payload:
+            values[obis.CODES[code]["internal_name"]] = value
+            continue
+        logging.debug("{}: {}".format(topic, value))
+        client.publish(topic, value)
+    if values:
+        values["timestamp"] = snapshot.timestamp
+        payload = json.dumps(values, separators=(",", ":"))
+        logging.debug("{}: {}".format(base_topic, payload))
+        client.publish(base_topic, payload)
+    instrumentation.DURATIONS.observe(time.perf_counter() - start, ("mqtt",))
+
+
+class ChangePublisher():
+    # publishes every new snapshot, but only the values that changed by more than
+    # 'threshold'. all values of a meter are published every 'refresh_interval' seconds
+    def __init__(self, client, threshold, refresh_interval):
+        self.client = client
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        self.versions = {}
+        self.published = {}
+        self.refreshed = {}
+
+    def publish(self, snapshots):
+        now = time.monotonic()
+        for meter_id, snapshot in snapshots.items():
+            refresh = meter_id not in self.refreshed or now - self.refreshed[meter_id] >= self.refresh_interval
+            if not refresh and self.versions.get(meter_id) == snapshot.version:
+                continue
+            published = self.published.setdefault(meter_id, {})
+            if refresh:
+                self.refreshed[meter_id] = now
+                publish_snapshot(self.client, meter_id, snapshot, published)
+            else:
+                publish_snapshot(self.client, meter_id, snapshot, published, self.threshold)
+            self.versions[meter_id] = snapshot.version
+
+
+def start_mqtt(client, interval):
     time.sleep(5)
     while True:
-        lock = threading.Lock()
-        with lock:
-            if shared_sml_data.SML_RAW_DATA is not None:
-                list_response = shared_sml_data.SML_RAW_DATA.GetRoot().GetListResponse()
-                if list_response is not None:
-                    logging.info("Publishing OBIS data to MQTT")
-                    obis_data = sml.extract_obis_response_data(list_response)
-                    manufacturer_data = obis_data[obis.CODE_MANUFACTURER]
-                    manufacturer = manufacturer_data["value"] if manufacturer_data["value"] is not None else "unknown_manufacturer"
-                    
-                    serial_data = obis_data[obis.CODE_SERIAL]
-                    serial = serial_data["value"] if serial_data["value"] is not None else "unknown_serial"
-                    
-                    serverid_data = obis_data[obis.CODE_ID]
-                    serverid = serverid_data["value"].replace(" ","-") if serverid_data["value"] is not None else "unknown_serverid"
-                    for _, data in obis_data.items():
-                        if data["type"] in [obis.TYPE_GAUGE, obis.TYPE_COUNTER]:
-                            value = 0 if data["value"] is None else data["value"]
-                            
-                            topic = "sml/{}/{}/{}/{}".format(manufacturer, serial, serverid, data["internal_name"])
-                            msg = value
-                            logging.debug("{}: {}".format(topic, msg))
-                            client.publish(topic, msg)
-                else:
-                    logging.warning("Could not publish any OBIS data - none found in the last SML message")
-            else:
-                logging.warning("Could not publish any OBIS data - no SML data received (yet)")
+        snapshots = shared_sml_data.get_snapshots()
+        if not snapshots:
+            logging.warning("Could not publish any OBIS data - no SML data received (yet)")
+        for meter_id, snapshot in snapshots.items():
+            publish_snapshot(client, meter_id, snapshot)
         time.sleep(interval)
+
+
+def start_mqtt_on_change(client, threshold, refresh_interval):
+    publisher = ChangePublisher(client, threshold, refresh_interval)
+    version = 0
+    while True:
+        snapshot = shared_sml_data.wait_for_snapshot(version, refresh_interval)
+        if snapshot is not None:
+            version = snapshot.version
+        publisher.publish(shared_sml_data.get_snapshots())
@@ -0,0 +1,250 @@
+import asyncio
+import binascii
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+import history
+import http_api
+import instrumentation
+import shared_sml_data
+import sml
+
+# decoded snapshots of the reader process in a ring of fixed size slots in shared
+# memory. HTTP API workers in other processes read them from there, so serving the
+# API never competes with the serial readers for the GIL. layout (little endian):
+#   header: magic (8 bytes) | slot count (uint32) | slot size (uint32) | metrics size (uint32) | number of the latest record (uint64)
+#   blocks: sequence (uint64) | record number (uint64) | length (uint32) | crc32 (uint32) | data
+# the first block holds the sml_reader_* metrics of the reader process, the slots
+# follow. a slot holds one snapshot as JSON, record n is written to slot n % slot count.
+# every block is guarded by a seqlock: the writer makes the sequence odd before and
+# even again after changing the block. readers copy the data and only use it if the
+# sequence was even and did not change meanwhile. python has no memory barriers, so
+# the checksum additionally catches copies torn by CPUs that reorder memory accesses
+
+MAGIC = b"SMLRING1"
+HEADER = struct.Struct("<8sIIIQ")
+HEAD_OFFSET = 20
+SEQUENCE = struct.Struct("<Q")
+BLOCK = struct.Struct("<QQII")
+# how often a reader retries a block the writer is busy with
+READ_RETRIES = 100
+# how often workers look for new records (in seconds)
+POLL_INTERVAL = 0.02
+# how often the metrics of the reader process are copied to the ring (in seconds)
+METRICS_INTERVAL = 1.0
+
+
+class RingWriter():
+    # creates the ring, there is exactly one writer per ring
+    def __init__(self, slot_count=64, slot_size=16384, metrics_size=262144):
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.metrics_size = metrics_size
+        size = HEADER.size + BLOCK.size + metrics_size + slot_count * (BLOCK.size + slot_size)
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        # shared memory starts out zeroed: no records, all sequences even
+        self.buffer = self.memory.buf
+        HEADER.pack_into(self.buffer, 0, MAGIC, slot_count, slot_size, metrics_size, 0)
+        self.count = 0
+        self.metrics_count = 0
+        self.metrics_written = None
+        self.versions = {}
+        self.lock = threading.Lock()
+        logging.info("Created snapshot ring {} ({} slots of {} bytes)".format(self.name, slot_count, slot_size))
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write_block(self, offset, number, data):
+        buffer = self.buffer
+        sequence = SEQUENCE.unpack_from(buffer, offset)[0] + 1
+        SEQUENCE.pack_into(buffer, offset, sequence)
+        BLOCK.pack_into(buffer, offset, sequence, number, len(data), binascii.crc32(data))
+        start = offset + BLOCK.size
+        buffer[start:start + len(data)] = data
+        SEQUENCE.pack_into(buffer, offset, sequence + 1)
+
+    def append(self, record):
+        # appends a JSON serializable record, returns False if it does not fit into a slot
+        data = json.dumps(record).encode()
+        if len(data) > self.slot_size:
+            logging.warning("Snapshot of meter {} does not fit into a ring slot ({} bytes), dropping it".format(record["meter_id"], len(data)))
+            return False
+        with self.lock:
+            number = self.count + 1
+            self.write_block(get_slot_offset(number, self.slot_count, self.slot_size, self.metrics_size), number, data)
+            self.count = number
+            # the record is complete, readers may look at it now
+            SEQUENCE.pack_into(self.buffer, HEAD_OFFSET, number)
+        return True
+
+    def write(self, snapshots):
+        # appends every snapshot that has not been written yet, oldest first
+        for meter_id, snapshot in sorted(snapshots.items(), key=lambda item: item[1].version):
+            if self.versions.get(meter_id) == snapshot.version:
+                continue
+            self.versions[meter_id] = snapshot.version
+            self.append({
+                "version": snapshot.version,
+                "timestamp": snapshot.timestamp,
+                "meter_id": meter_id,
+                "obis_data": sml.get_obis_data(snapshot),
+            })
+
+    def write_metrics(self, output):
+        data = output.encode()
+        if len(data) > self.metrics_size:
+            logging.warning("Metrics do not fit into the snapshot ring ({} bytes), dropping them".format(len(data)))
+            return
+        with self.lock:
+            self.metrics_count += 1
+            self.write_block(HEADER.size, self.metrics_count, data)
+            self.metrics_written = time.monotonic()
+
+    def update_metrics(self):
+        # copies the metrics of this process at most every METRICS_INTERVAL seconds
+        if self.metrics_written is None or time.monotonic() - self.metrics_written >= METRICS_INTERVAL:
+            self.write_metrics(instrumentation.render())
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+        self.memory.unlink()
+
+
+class RingReader():
+    # attaches to a ring by name, any number of readers can read at the same time
+    def __init__(self, name):
+        self.memory = shared_memory.SharedMemory(name=name)
+        self.buffer = self.memory.buf
+        magic, self.slot_count, self.slot_size, self.metrics_size, _ = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a snapshot ring".format(name))
+        # number of the latest record published by sync()
+        self.head = 0
+
+    def get_head(self):
+        return SEQUENCE.unpack_from(self.buffer, HEAD_OFFSET)[0]
+
+    def read_block(self, offset, capacity):
+        # returns (record number, data) of a block or None if it could not be read
+        buffer = self.buffer
+        for _ in range(READ_RETRIES):
+            sequence, number, length, crc = BLOCK.unpack_from(buffer, offset)
+            if sequence & 1 or length > capacity:
+                time.sleep(0)
+                continue
+            start = offset + BLOCK.size
+            data = bytes(buffer[start:start + length])
+            if SEQUENCE.unpack_from(buffer, offset)[0] == sequence and binascii.crc32(data) == crc:
+                return number, data
+        return None
+
+    def read_records(self, first=1):
+        # yields (record number, record) of all records from 'first' on that are
+        # still in the ring, oldest first
+        head = self.get_head()
+        for number in range(max(first, head - self.slot_count + 1, 1), head + 1):
+            block = self.read_block(get_slot_offset(number, self.slot_count, self.slot_size, self.metrics_size), self.slot_size)
+            # the slot might have been overwritten by a newer record meanwhile
+            if block is None or block[0] != number:
+                continue
+            yield number, decode_record(block[1])
+
+    def read_metrics(self):
+        block = self.read_block(HEADER.size, self.metrics_size)
+        if block is None:
+            return ""
+        return block[1].decode()
+
+    def sync(self):
+        # publishes all records written since the last call to shared_sml_data of
+        # this process, returns True if there were any
+        head = self.head
+        for number, record in self.read_records(head + 1):
+            snapshot = shared_sml_data.Snapshot(record["version"], None, record["meter_id"], {"obis_data": record["obis_data"]}, record["timestamp"])
+            shared_sml_data.import_snapshot(snapshot)
+            self.head = number
+        return self.head != head
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+
+
+def get_slot_offset(number, slot_count, slot_size, metrics_size):
+    return HEADER.size + BLOCK.size + metrics_size + (number % slot_count) * (BLOCK.size + slot_size)
+
+
+def decode_record(data):
+    record = json.loads(data)
+    # JSON only knows string keys, OBIS data is keyed by the code ids
+    if record["obis_data"] is not None:
+        record["obis_data"] = {int(code): item for code, item in record["obis_data"].items()}
+    return record
+
+
+def start_ring_writer(writer):
+    version = 0
+    while True:
+        snapshot = shared_sml_data.wait_for_snapshot(version, METRICS_INTERVAL)
+        if snapshot is not None:
+            version = snapshot.version
+        writer.write(shared_sml_data.get_snapshots())
+        writer.update_metrics()
+
+
+async def poll_ring(reader, queue):
+    # the ring cannot notify other processes, so workers look for new records.
+    # workers stop once the reader process is gone
+    parent = os.getppid()
+    while os.getppid() == parent:
+        if reader.sync():
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def serve_ring(reader, bind_ip, bind_port, max_connections, keep_alive_timeout, backlog):
+    queue = asyncio.Queue(maxsize=1)
+    reader.sync()
+    # the server is cancelled by asyncio.run() once polling stopped
+    asyncio.create_task(http_api.serve_async_api(bind_ip, bind_port, queue, max_connections, keep_alive_timeout, backlog, reuse_port=True))
+    await poll_ring(reader, queue)
+    logging.info("Reader process is gone, stopping HTTP API worker")
+
+
+def serve_worker(name, bind_ip, bind_port, max_connections, keep_alive_timeout, backlog, history_dir, log_level):
+    # entry point of the API worker processes. all workers bind to the same port,
+    # the kernel distributes the connections between them
+    logging.basicConfig(level=log_level, format="[%(levelname)s] [%(processName)s] %(message)s")
+    reader = RingReader(name)
+    http_api.RENDER_READER_METRICS = reader.read_metrics
+    if history_dir is not None:
+        # only queries, recent records show up once the reader process flushed them
+        http_api.HISTORY_STORE = history.HistoryStore(history_dir)
+    try:
+        asyncio.run(serve_ring(reader, bind_ip, bind_port, max_connections, keep_alive_timeout, backlog))
+    finally:
+        reader.close()
+
+
+def start_workers(name, count, bind_ip, bind_port, max_connections=1000, keep_alive_timeout=60, backlog=1024, history_dir=None):
+    # workers are spawned instead of forked, the reader process might already run threads
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for index in range(count):
+        worker = context.Process(name="HttpApi-{}".format(index), target=serve_worker, daemon=True, args=(
+            name, bind_ip, bind_port, max_connections, keep_alive_timeout, backlog, history_dir, logging.getLogger().getEffectiveLevel()))
+        worker.start()
+        workers.append(worker)
+    logging.info("Started {} HTTP API workers serving snapshot ring {}".format(count, name))
+    return workers
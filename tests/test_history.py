@@ -0,0 +1,48 @@
+import logging
+import math
+import shutil
+import tempfile
+import unittest
+
+import history
+import obis
+
+
+class AggregateTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.path = tempfile.mkdtemp()
+        self.store = history.HistoryStore(self.path)
+        self.name = self.store.names[0]
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+        logging.disable(logging.NOTSET)
+
+    def append(self, timestamp, value):
+        obis_data = {code: {"value": None} for code in obis.CODES}
+        obis_data[self.store.codes[0]]["value"] = value
+        self.store.append("meter", timestamp, obis_data)
+
+    def test_leading_missing_values(self):
+        # a NaN at the start of a bucket used to win every comparison
+        start = 1600000000 // 3600 * 3600
+        for offset, value in [(0, None), (10, None), (60, 5.0), (70, 3.0), (80, 7.0)]:
+            self.append(start + offset, value)
+        for step in (90, 120):
+            resolution, result = self.store.aggregate("meter", [self.name], start, start + 3600, step, ["min", "max"])
+            self.assertEqual(resolution, 60 if step == 120 else None)
+            self.assertEqual(result[self.name]["min"], [(start, 3.0)])
+            self.assertEqual(result[self.name]["max"], [(start, 7.0)])
+
+    def test_missing_bucket(self):
+        start = 1600000000 // 3600 * 3600
+        self.append(start, None)
+        resolution, result = self.store.aggregate("meter", [self.name], start, start + 3600, 60, ["min", "max"])
+        self.assertTrue(math.isnan(result[self.name]["min"][0][1]))
+        self.assertTrue(math.isnan(result[self.name]["max"][0][1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import logging
+import os
+import unittest
+
+import sml
+
+CAPTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "captures")
+
+
+def read_capture_frames(name):
+    # raw frames (start sequence up to the checksum) of a capture
+    with open(os.path.join(CAPTURES, name), "rb") as fin:
+        data = fin.read()
+    frames = []
+    start = data.find(sml.START_SEQ)
+    while start >= 0:
+        following = data.find(sml.START_SEQ, start + 1)
+        end = following if following >= 0 else len(data)
+        frames.append(data[start:end])
+        start = following
+    return frames
+
+
+class FrameScannerTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_many_corrupted_frames_in_one_chunk(self):
+        # every discarded frame used to recurse once, thousands of them in a single
+        # chunk exceeded the recursion limit
+        frame = read_capture_frames("ed300l.bin")[0]
+        frame = frame[:frame.rfind(sml.ESCAPE_SEQ + b"\x1a") + 8]
+        corrupted = frame[:-1] + bytes([frame[-1] ^ 0xff])
+        scanner = sml.FrameScanner()
+        frames = [bytes(msg) for msg, footer in scanner.feed(corrupted * 3000 + frame)]
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(scanner.crc_errors, 3000)
+
+
+if __name__ == "__main__":
+    unittest.main()